@@ -13,9 +13,16 @@
 #  DB 0x0a   ; a hex byte
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
+#
+#  INCLUDE lib.asm ; assemble another file in at this point
 
+import argparse
+import hashlib
+import json
+import os
 import sys
 import re
+import struct
 
 # Opcodes
 OPCODES = {
@@ -55,20 +62,123 @@ OPCODES = {
     "XOR":  {"type": 2, "code": "10101011"},
 }
 
+# Binary image format (.ls8b), as loaded by the emulator's CPU.load_image():
+# an 8-byte header (magic "LS8\0", version, flags, program length), the
+# 256-byte memory image, then an optional symbol section (count, and an
+# address, name length and name for each symbol)
+IMAGE_MAGIC = b"LS8\0"
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct("<4sBBH")
+IMAGE_HAS_SYMBOLS = 0b00000001
+
+# Opcode values as ints, and every byte's text form, worked out once
+OPCODE_VALUES = {name: int(info["code"], 2) for name, info in OPCODES.items()}
+BYTE_TEXT = ["{:08b}".format(v) for v in range(256)]
+
 # Regex for matching lines
 # Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+LINE_PATTERN = re.compile(r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(-?\w+))?)?)?")
+
+# Regex for register operands, and the usual spellings looked up directly
+REGISTER_PATTERN = re.compile(r"R([0-7])")
+REGISTERS = {f"R{r}": r for r in range(8)}
+
+
+class AssemblyError(Exception):
+    """
+    An error in the source. Carries the exit status asm.py reports it with.
+    """
+
+    def __init__(self, message, status=2):
+        super().__init__(message)
+        self.status = status
+
+
+class Program:
+    """
+    The intermediate representation built by pass1: the machine code as a
+    list of ints, with what pass2 needs to finish and annotate it.
+    """
+
+    def __init__(self):
+        # one int per byte of machine code
+        self.code = []
+
+        # for each byte, the source it came from if it starts an
+        # instruction or is data, else None
+        self.comments = []
 
-# Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+        # addresses where instructions (rather than data) start
+        self.instructions = []
+
+        # label name -> address
+        self.sym = {}
+
+        # address -> names of the labels there, in source order
+        self.labels = {}
+
+        # (address, symbol, line number) for every byte that holds a
+        # symbol's address, patched in once all labels are known
+        self.fixups = []
+
+    def link(self, other):
+        """
+        Append another program's code here, relocating its labels and
+        symbol references to where it lands.
+        """
+
+        base = len(self.code)
+
+        self.code.extend(other.code)
+        self.comments.extend(other.comments)
+        self.instructions.extend(address + base for address in other.instructions)
+
+        for name, address in other.sym.items():
+            self.sym[name] = address + base
+
+        for address, names in other.labels.items():
+            self.labels.setdefault(address + base, []).extend(names)
+
+        self.fixups.extend(
+            (address + base, symbol, line_num)
+            for address, symbol, line_num in other.fixups
+        )
+
+    def to_dict(self):
+        return {
+            "code": self.code,
+            "comments": self.comments,
+            "instructions": self.instructions,
+            "sym": self.sym,
+            "labels": self.labels,
+            "fixups": self.fixups,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        program = cls()
+        program.code = data["code"]
+        program.comments = data["comments"]
+        program.instructions = data["instructions"]
+        program.sym = data["sym"]
+        # JSON object keys are always strings
+        program.labels = {int(a): names for a, names in data["labels"].items()}
+        program.fixups = [tuple(fixup) for fixup in data["fixups"]]
+        return program
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [inputfile] [outputfile]
+
+    If outputfile ends in .ls8b, a binary image is written instead of text.
+    -O runs the peephole optimizer.
     """
 
+    optimize = "-O" in argv[1:]
+    if optimize:
+        argv = [arg for arg in argv if arg != "-O"]
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -82,16 +192,17 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-O] [infile.asm] [outfile.ls8]", file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    return inputfile, outputfile, optimize
 
 
-def open_files(inputfile, outputfile):
+def open_files(inputfile, outputfile, binary=False):
     """
     Open files for reading and writing. If either of the files are named "-",
-    stdin or stdout is returned as appropriate.
+    stdin or stdout is returned as appropriate. If binary is True, the output
+    file is opened for writing bytes.
     """
 
     if inputfile == "-":
@@ -100,210 +211,191 @@ def open_files(inputfile, outputfile):
         inputfile = open(inputfile)
 
     if outputfile == "-":
-        outputfile = sys.stdout
+        outputfile = sys.stdout.buffer if binary else sys.stdout
     else:
-        outputfile = open(outputfile, "w")
+        outputfile = open(outputfile, "wb" if binary else "w")
 
     return inputfile, outputfile
 
 
-def normalize_line(groups):
+def p8(v):
+    return BYTE_TEXT[v] if 0 <= v < 256 else "{:08b}".format(v)
+
+
+def tokenize(inputfile):
     """
-    Takes match groups and uppercases them if they're not None.
+    Split source lines into tokens. Yields (line_num, label, opcode, op_a,
+    op_b, data) for every line that isn't blank, uppercased, with None for
+    anything missing. data is the raw argument of a DS, DB or INCLUDE
+    line.
     """
 
-    result = []
+    match = LINE_PATTERN.match
 
-    for g in groups:
-        if g is None:
-            result.append(None)
-        else:
-            result.append(g.upper())
+    for line_num, line in enumerate(inputfile, 1):
+        # Strip comments, normalize
+        line = line.partition(';')[0].strip()
 
-    return result
+        # Ignore blank lines
+        if not line:
+            continue
 
+        # Everything but DS strings is case-insensitive, so match
+        # the uppercased line and get uppercased tokens
+        m = match(line.upper())
 
-def p8(v):
-    return "{:08b}".format(v)
+        if m is None:
+            raise AssemblyError(f"line {line_num}: no match: {line}", 3)
 
+        label, opcode, op_a, op_b = m.groups()
+        data = None
 
-def pass1(inputfile, sym, code):
+        if opcode == 'DS' or opcode == 'DB' or opcode == 'INCLUDE':
+            # Everything after the pseudo-opcode, case and all
+            data = line[match(line).end(2):].lstrip()
+            op_a = op_b = None
+
+        yield line_num, label, opcode, op_a, op_b, data
+
+
+def pass1(inputfile, program, include=None):
     """
     Pass 1
 
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
+    * Tokenize the source code lines
     * Record label offsets
-    * Emit machine code
+    * Emit machine code as ints, noting symbols to fix up in pass 2
+    * Link in included files, via include(name) -> Program
     """
 
+    code = program.code
+    comments = program.comments
+    instructions = program.instructions
+    sym = program.sym
+    labels = program.labels
+    fixups = program.fixups
+
     # Source line number
     line_num = 0
 
-    # Current code address (for labels)
-    addr = 0
-
-    def get_reg(op, fatal=True):
+    def get_reg(op):
         """Get a register number from a string, e.g. "R2" -> 2"""
 
-        nonlocal line_num
+        if op in REGISTERS:
+            return REGISTERS[op]
 
-        m = re.match(r"R([0-7])", op)
+        m = REGISTER_PATTERN.match(op)
 
         if m is None:
-            if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
-            else:
-                return None
+            raise AssemblyError(f"Line {line_num}: unknown register {op}", 1)
 
         return int(m.group(1))
 
-    def out0(opcode, op_a, op_b, machine_code):
+    def out0(opcode, op_a, op_b):
         """Handle opcodes with zero operands"""
 
-        nonlocal addr
+        instructions.append(len(code))
+        code.append(OPCODE_VALUES[opcode])
+        comments.append(opcode)
 
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
-
-    def out1(opcode, op_a, op_b, machine_code):
+    def out1(opcode, op_a, op_b):
         """Handle opcodes with one operand"""
 
-        nonlocal addr
-
-        reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+        instructions.append(len(code))
+        code.append(OPCODE_VALUES[opcode])
+        code.append(get_reg(op_a))
+        comments.append(f"{opcode} {op_a}")
+        comments.append(None)
 
-    def out2(opcode, op_a, op_b, machine_code):
+    def out2(opcode, op_a, op_b):
         """Handle opcodes with two operands"""
 
-        nonlocal addr
-
-        reg_a = get_reg(op_a)
-        reg_b = get_reg(op_b)
-
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
-
-        addr += 3
+        instructions.append(len(code))
+        code.append(OPCODE_VALUES[opcode])
+        code.append(get_reg(op_a))
+        code.append(get_reg(op_b))
+        comments.append(f"{opcode} {op_a},{op_b}")
+        comments.append(None)
+        comments.append(None)
 
-    def out8(opcode, op_a, op_b, machine_code):
+    def out8(opcode, op_a, op_b):
         """Handle LDI opcode (type 8)"""
 
-        nonlocal addr
-
-        reg_a = get_reg(op_a)
+        instructions.append(len(code))
+        code.append(OPCODE_VALUES[opcode])
+        code.append(get_reg(op_a))
 
         try:
-            val_b = int(op_b, 0)
-            out_b = p8(val_b)
+            value = int(op_b, 0)
 
         except ValueError:
             # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+            fixups.append((len(code), op_b, line_num))
+            code.append(0)
+
+        else:
+            # The value has to fit in the instruction's one byte
+            if not 0 <= value <= 0xff:
+                raise AssemblyError(
+                    f"Line {line_num}: immediate {op_b} out of range (0-255)", 1)
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
+            code.append(value)
 
-        addr += 3
+        comments.append(f"{opcode} {op_a},{op_b}")
+        comments.append(None)
+        comments.append(None)
 
-    def handle_ds(line):
+    def handle_ds(data):
         """
         Handle DS pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
-
-        if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
-
-        data = m.group(2)
-
-        for i in range(len(data)):
-            print_char = data[i]
+        if not data:
+            raise AssemblyError(f"line {line_num}: missing argument to DS", 2)
 
-            if print_char == ' ':
-                print_char = '[space]'
+        for char in data:
+            code.append(ord(char))
+            comments.append('[space]' if char == ' ' else char)
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
-
-        addr += len(data)
-
-    def handle_db(line):
+    def handle_db(data):
         """
         Handle the DB pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
-
-        if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
-
-        data = m.group(2)
+        if not data:
+            raise AssemblyError(f"line {line_num}: missing argument to DB", 2)
 
         try:
             val = int(data, 0)
 
         except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+            raise AssemblyError(
+                f"line {line_num}: invalid integer argument to DB", 2)
 
         # Force to byte size
-        val &= 0xff
-
-        code.append(f"{p8(val)} # {data}")
-
-        addr += 1
+        code.append(val & 0xff)
+        comments.append(data)
 
     def check_ops(opcode, op_a, op_b):
         """Check operands for sanity with a particular opcode"""
 
-        def check_ops_count(desired, found):
-            # Makes sure we have right operand count
-            if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-            elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-
         # Make sure we know this opcode at all
         if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+            raise AssemblyError(f"line {line_num}: unknown opcode {opcode}", 2)
 
         op_type = OPCODES[opcode]["type"]
 
-        total_operands = 0
-
-        if op_a is not None:
-            total_operands += 1
-
-        if op_b is not None:
-            total_operands += 1
-
-        if op_type == 0 or op_type == 1 or op_type == 2:
-            # 0, 1, or 2 register operands
-            check_ops_count(op_type, total_operands)
+        # LDI r,i or LDI r,label; otherwise 0, 1, or 2 register operands
+        desired = 2 if op_type == 8 else op_type
+        found = (op_a is not None) + (op_b is not None)
 
-        elif op_type == 8:
-            # LDI r,i or LDI r,label
-            check_ops_count(2, total_operands)
+        # Makes sure we have right operand count
+        if found < desired:
+            raise AssemblyError(
+                f"Line {line_num}: missing operand to {opcode}", 1)
+        elif found > desired:
+            raise AssemblyError(
+                f"Line {line_num}: unexpected operand to {opcode}", 1)
 
     # Type to function mapping
     type_f = {
@@ -313,90 +405,600 @@ def pass1(inputfile, sym, code):
         8: out8,
     }
 
-    for line in inputfile:
-        line_num += 1
+    # Opcode to function mapping, so each line is one lookup
+    handlers = {
+        opcode: type_f[info["type"]] for opcode, info in OPCODES.items()
+    }
 
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
+    for line_num, label, opcode, op_a, op_b, data in tokenize(inputfile):
+        # Track label address
+        if label is not None:
+            addr = len(code)
+            sym[label] = addr
+            labels.setdefault(addr, []).append(label)
 
-        # Normalize
-        line = line.strip()
+        if opcode is None:
+            continue
 
-        # Ignore blank lines
-        if input == '':
+        if opcode == 'DS':
+            handle_ds(data)
+        elif opcode == 'DB':
+            handle_db(data)
+        elif opcode == 'INCLUDE':
+            if not data:
+                raise AssemblyError(
+                    f"line {line_num}: missing argument to INCLUDE", 2)
+            if include is None:
+                raise AssemblyError(
+                    f"line {line_num}: INCLUDE isn't available here", 2)
+            program.link(include(data.strip('"')))
+        else:
+            # Check operand count
+            check_ops(opcode, op_a, op_b)
+
+            # Handle opcodes
+            handlers[opcode](opcode, op_a, op_b)
+
+
+def resolve(program):
+    """
+    Patch every symbol reference with the symbol's address.
+    """
+
+    code = program.code
+    sym = program.sym
+
+    for address, symbol, line_num in program.fixups:
+        if symbol not in sym:
+            raise AssemblyError(
+                f"line {line_num}: unknown symbol: {symbol}", 2)
+
+        code[address] = sym[symbol]
+
+
+# -- PEEPHOLE OPTIMIZER --
+
+LDI = OPCODE_VALUES["LDI"]
+JMP = OPCODE_VALUES["JMP"]
+PUSH = OPCODE_VALUES["PUSH"]
+POP = OPCODE_VALUES["POP"]
+CMP = OPCODE_VALUES["CMP"]
+
+# Control never falls through past these
+NO_FALLTHROUGH = {OPCODE_VALUES[name] for name in ("HLT", "JMP", "RET", "IRET")}
+
+# After these, nothing is known about any register
+CLOBBERS_ALL = {OPCODE_VALUES[name] for name in ("CALL", "RET", "IRET", "INT")}
+
+# These change the register in their first operand. Every ALU op (opcode
+# bit 5 set) does too, except CMP
+WRITES_REG_A = {OPCODE_VALUES[name] for name in ("LD", "POP")}
+
+# These move the stack pointer
+MOVES_SP = {OPCODE_VALUES[name] for name in ("PUSH", "POP", "CALL", "RET")}
+
+SP = 7
+
+# IM and IS. Hardware sets IS bits whenever an interrupt arrives, so an
+# LDI to either (like LDI R6,0 acknowledging an interrupt) is always kept
+INTERRUPT_REGS = {5, 6}
+
+
+def optimize(program):
+    """
+    Peephole-optimize an unresolved program, returning a new Program:
+
+    * LDI Rx,L; JMP Rx that lands on another LDI Rx,M; JMP Rx jumps
+      straight to M
+    * LDI of a value the register is known to hold already is dropped,
+      except to IM and IS (R5 and R6)
+    * PUSH Rx followed straight away by POP Rx is dropped, pair and all
+    * Instructions after HLT, JMP, RET or IRET that no label leads to are
+      dropped
+
+    Labels and symbol references are relocated to match. Only symbolic
+    addresses can be relocated, so code that jumps to numeric addresses
+    shouldn't be optimized.
+    """
+
+    while True:
+        optimized = optimize_once(program)
+
+        if len(optimized.code) == len(program.code):
+            return optimized
+
+        program = optimized
+
+
+def optimize_once(program):
+    """One pass of optimize()."""
+
+    code = program.code
+    labels = program.labels
+    instructions = set(program.instructions)
+
+    # Split the code into (address, length, is_instruction) items
+    items = []
+    address = 0
+    while address < len(code):
+        if address in instructions:
+            length = (code[address] >> 6) + 1
+            items.append((address, length, True))
+        else:
+            length = 1
+            items.append((address, length, False))
+        address += length
+
+    index_at = {item[0]: i for i, item in enumerate(items)}
+
+    # Symbol references by address, which threading may retarget
+    fixup_at = {address: symbol for address, symbol, _ in program.fixups}
+    fixup_line = {address: line_num for address, _, line_num in program.fixups}
+
+    def ldi_jmp(i):
+        """
+        If items i and i+1 are LDI Rx,symbol; JMP Rx, return
+        (Rx, symbol), else None.
+        """
+
+        if i + 1 >= len(items):
+            return None
+
+        (address, _, is_instruction), (next_address, _, next_is_instruction) = items[i:i + 2]
+
+        if (not is_instruction or not next_is_instruction
+                or code[address] != LDI or code[next_address] != JMP
+                or code[address + 1] != code[next_address + 1]
+                or address + 2 not in fixup_at):
+            return None
+
+        return code[address + 1], fixup_at[address + 2]
+
+    # Thread jumps to jumps
+    for i, (address, _, _) in enumerate(items):
+        pair = ldi_jmp(i)
+        if pair is None:
             continue
 
-        # print(line)  # debug
+        reg, symbol = pair
+        seen = {symbol}
 
-        m = re.match(REGEX, line)
+        while True:
+            target = program.sym.get(symbol)
+            if target not in index_at:
+                break
 
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
+            hop = ldi_jmp(index_at[target])
+            if hop is None or hop[0] != reg or hop[1] in seen:
+                break
 
-            # print(label, opcode, op_a, op_b)  # debug
+            symbol = hop[1]
+            seen.add(symbol)
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+        fixup_at[address + 2] = symbol
 
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
-                else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
+    # Decide which items to keep
+    keep = [True] * len(items)
+
+    # register -> the value (int, or symbol name) it's known to hold
+    known = {}
+    reachable = True
+
+    for i, (address, length, is_instruction) in enumerate(items):
+        if not keep[i]:
+            continue
+
+        # Anything could jump to a label
+        if address in labels:
+            known = {}
+            reachable = True
+
+        if not is_instruction:
+            known = {}
+            continue
+
+        if not reachable:
+            keep[i] = False
+            continue
+
+        op = code[address]
+        reg = code[address + 1] if length > 1 else None
+
+        if op == LDI:
+            value = fixup_at.get(address + 2, code[address + 2])
+
+            if reg in INTERRUPT_REGS:
+                pass
+            elif known.get(reg) == value:
+                keep[i] = False
+            else:
+                known[reg] = value
+
+        elif (op == PUSH and reg != SP and i + 1 < len(items)
+                and items[i + 1][2] and items[i + 1][0] not in labels
+                and code[items[i + 1][0]] == POP
+                and code[items[i + 1][0] + 1] == reg):
+            keep[i] = keep[i + 1] = False
+
+        elif op in CLOBBERS_ALL:
+            known = {}
 
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
         else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+            if op in WRITES_REG_A or (op & 0b00100000 and op != CMP):
+                known.pop(reg, None)
+
+            if op in MOVES_SP:
+                known.pop(SP, None)
+
+        if op in NO_FALLTHROUGH:
+            reachable = False
+
+    # Relocate: every old address maps to where its item (or, for a
+    # dropped item, the next kept one) ends up
+    optimized = Program()
+    new_address = [0] * (len(code) + 1)
+
+    for (address, length, is_instruction), kept in zip(items, keep):
+        position = len(optimized.code)
+
+        if not kept:
+            for offset in range(length):
+                new_address[address + offset] = position
+            continue
+
+        if is_instruction:
+            optimized.instructions.append(position)
+
+        for offset in range(length):
+            new_address[address + offset] = position + offset
+
+            if address + offset in fixup_at:
+                optimized.fixups.append((
+                    position + offset, fixup_at[address + offset],
+                    fixup_line[address + offset]
+                ))
+
+        optimized.code.extend(code[address:address + length])
+        optimized.comments.extend(program.comments[address:address + length])
 
+    new_address[len(code)] = len(optimized.code)
 
-def pass2(outputfile, sym, code):
+    for address, names in labels.items():
+        optimized.labels.setdefault(new_address[address], []).extend(names)
+
+    optimized.sym = {
+        name: new_address[address] for name, address in program.sym.items()
+    }
+
+    return optimized
+
+
+def pass2(outputfile, program):
     """
-    Output the code, substituting in any symbols.
+    Output the code as .ls8 text, all in one write.
     """
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
+    code = program.code
+    comments = program.comments
+    labels = program.labels
 
-            if s in sym:
-                c = p8(sym[s])
+    # Every byte's text at once
+    texts = [
+        BYTE_TEXT[value] if 0 <= value < 256 else p8(value) for value in code
+    ]
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
+    if not labels:
+        lines = [
+            text if comment is None else f"{text} # {comment}"
+            for text, comment in zip(texts, comments)
+        ]
+    else:
+        lines = []
+        append = lines.append
+
+        for address, text in enumerate(texts):
+            if address in labels:
+                for label in labels[address]:
+                    append(f"# {label} (address {address}):")
+
+            comment = comments[address]
+            append(text if comment is None else f"{text} # {comment}")
+
+    # Labels after the last byte
+    for label in labels.get(len(code), ()):
+        append(f"# {label} (address {len(code)}):")
+
+    lines.append("")
+    outputfile.write("\n".join(lines))
+
+
+def pass2_image(outputfile, program):
+    """
+    Output the code as a binary .ls8b image.
+    """
+
+    sym = program.sym
+
+    if len(program.code) > 256:
+        raise AssemblyError(
+            f"program too large: {len(program.code)} bytes", 2)
+
+    code = bytes(program.code)
+
+    # Symbol section: count, then address, name length and name
+    symbols = bytearray(len(sym).to_bytes(2, "little"))
+    for name, address in sym.items():
+        encoded = name.encode("ascii")
+        symbols.append(address)
+        symbols.append(len(encoded))
+        symbols += encoded
+
+    flags = IMAGE_HAS_SYMBOLS if sym else 0
+
+    outputfile.write(IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, flags,
+                                       len(code))
+                     + code + bytes(256 - len(code))
+                     + (bytes(symbols) if sym else b""))
+
+
+# Bump when the cached object format changes, so old objects are ignored
+CACHE_VERSION = b"2"
+
+# INCLUDE lines, found without assembling the file
+INCLUDE_PATTERN = re.compile(
+    r"^[ \t]*(?:\w+:)?[ \t]*INCLUDE[ \t]+([^;\r\n]+)", re.IGNORECASE | re.MULTILINE)
+
+
+class Builder:
+    """
+    Assembles any number of files in one process. Each file is assembled
+    into an object (an unresolved Program) at most once per run, so files
+    INCLUDEd by many programs are assembled once and linked into each.
+
+    With a cache directory, objects are also kept on disk keyed by a hash
+    of the file's source and everything it includes, so a later build only
+    reassembles files that changed.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+
+        # path -> object, and path -> cache key, for this run
+        self.objects = {}
+        self.keys = {}
+
+        # files being assembled right now, to catch include cycles
+        self.assembling = set()
+
+        # how many objects were assembled and loaded from the cache
+        self.assembled = 0
+        self.cached = 0
+
+    def includes(self, path, source):
+        """The paths a file includes, relative to its own directory."""
+
+        directory = os.path.dirname(path)
+
+        return [
+            os.path.normpath(os.path.join(directory, name.strip().strip('"')))
+            for name in INCLUDE_PATTERN.findall(source)
+        ]
+
+    def key(self, path):
+        """
+        The cache key of a file: a hash of its source and of the keys of
+        every file it includes.
+        """
+
+        if path in self.keys:
+            return self.keys[path]
+
+        if path in self.assembling:
+            raise AssemblyError(f"{path}: include cycle", 2)
+
+        try:
+            with open(path, "rb") as f:
+                source = f.read()
+        except OSError as e:
+            raise AssemblyError(f"{path}: {e.strerror}", 2)
+
+        digest = hashlib.sha256(CACHE_VERSION)
+        digest.update(source)
+
+        self.assembling.add(path)
+        try:
+            for included in self.includes(path, source.decode()):
+                digest.update(self.key(included).encode())
+        finally:
+            self.assembling.discard(path)
+
+        self.keys[path] = key = digest.hexdigest()
+        return key
+
+    def object(self, path):
+        """The unresolved Program for a file, with its includes linked in."""
+
+        path = os.path.normpath(path)
+
+        if path in self.objects:
+            return self.objects[path]
+
+        key = self.key(path)
+        program = self.load_cached(key)
+
+        if program is None:
+            with open(path) as inputfile:
+                program = self.assemble_lines(inputfile, os.path.dirname(path))
+
+            self.save_cached(key, program)
+            self.assembled += 1
+        else:
+            self.cached += 1
+
+        self.objects[path] = program
+        return program
+
+    def assemble_lines(self, lines, directory):
+        """Run pass 1 over source lines, including files from directory."""
+
+        program = Program()
+        pass1(lines, program,
+              lambda name: self.object(os.path.join(directory, name)))
+        return program
 
-        outputfile.write(f"{c}\n")
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load_cached(self, key):
+        if self.cache_dir is None:
+            return None
+
+        try:
+            with open(self.cache_path(key)) as f:
+                return Program.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save_cached(self, key, program):
+        if self.cache_dir is None:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # write then rename, so a reader never sees half an object
+        temp = self.cache_path(key) + f".{os.getpid()}.tmp"
+        with open(temp, "w") as f:
+            json.dump(program.to_dict(), f)
+        os.replace(temp, self.cache_path(key))
+
+    def build(self, path, optimized=False):
+        """
+        The finished Program for a file, every symbol resolved, and
+        peephole-optimized if asked.
+        """
+
+        program = Program()
+        program.link(self.object(path))
+
+        if optimized:
+            program = optimize(program)
+
+        resolve(program)
+        return program
+
+
+def assemble(source, builder=None, optimized=False):
+    """
+    Assemble source code (a string, or an iterable of lines) in memory.
+    Returns (machine code as bytes, symbol table of label -> address),
+    ready for the emulator's CPU.load_program(). INCLUDEd files are found
+    relative to the current directory, through the given Builder if there
+    is one. If optimized is true, the peephole optimizer runs too. Raises
+    AssemblyError on bad source.
+    """
+
+    if isinstance(source, str):
+        source = source.splitlines()
+
+    if builder is None:
+        builder = Builder()
+
+    program = builder.assemble_lines(source, ".")
+
+    if optimized:
+        program = optimize(program)
+
+    resolve(program)
+
+    if len(program.code) > 256:
+        raise AssemblyError(f"program too large: {len(program.code)} bytes")
+
+    return bytes(program.code), dict(program.sym)
+
+
+def build_main(argv):
+    """
+    Usage: asm.py --build [--outdir DIR] [--cache DIR] [--binary] [-O]
+                  file.asm...
+
+    Assemble many files in one process, reusing cached objects for files
+    that haven't changed.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="asm.py --build",
+        description="Assemble many files, reassembling only what changed.")
+    parser.add_argument("sources", nargs="+", metavar="file.asm")
+    parser.add_argument("--outdir", default=".",
+                        help="where to write the output files")
+    parser.add_argument("--cache", default=".asmcache", metavar="DIR",
+                        help="object cache directory (default .asmcache)")
+    parser.add_argument("--binary", action="store_true",
+                        help="write .ls8b images instead of .ls8 text")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="run the peephole optimizer")
+    args = parser.parse_args(argv)
+
+    builder = Builder(args.cache)
+    extension = ".ls8b" if args.binary else ".ls8"
+    status = 0
+
+    for source in args.sources:
+        base = os.path.splitext(os.path.basename(source))[0]
+        outputfile = os.path.join(args.outdir, base + extension)
+
+        try:
+            program = builder.build(source, args.optimize)
+
+            with open(outputfile, "wb" if args.binary else "w") as f:
+                if args.binary:
+                    pass2_image(f, program)
+                else:
+                    pass2(f, program)
+
+        except AssemblyError as e:
+            print(f"{source}: {e}", file=sys.stderr)
+            status = max(status, e.status)
+
+    print(f"{len(args.sources)} files, {builder.assembled} assembled, "
+          f"{builder.cached} from cache", file=sys.stderr)
+
+    return status
 
 
 def main(argv):
+    if len(argv) > 1 and argv[1] == "--build":
+        return build_main(argv[2:])
+
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    inputfile, outputfile, optimized = parse_commandline(argv)
+
+    # Binary image or text output?
+    binary = outputfile.endswith(".ls8b")
+
+    # Includes are relative to the input file
+    directory = os.path.dirname(inputfile) if inputfile != "-" else "."
 
     # Open files
-    inputfile, outputfile = open_files(inputfile, outputfile)
+    inputfile, outputfile = open_files(inputfile, outputfile, binary)
 
-    # Set up the symbol table
-    sym = {}
+    try:
+        # Assemble
+        program = Builder().assemble_lines(inputfile, directory)
 
-    # Set up the machine code output
-    code = []
+        if optimized:
+            program = optimize(program)
+
+        resolve(program)
+
+        if binary:
+            pass2_image(outputfile, program)
+        else:
+            pass2(outputfile, program)
 
-    # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    except AssemblyError as e:
+        print(e, file=sys.stderr)
+        return e.status
 
     return 0
 
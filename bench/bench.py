@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the LS-8 emulator.
+
+Runs every program in ls8/examples and ls8/my_programs, plus a few generated
+long-running workloads, on each execution engine and reports instructions
+per second (MIPS), wall time and peak memory. Results can be saved as JSON
+and compared against an earlier run to catch regressions.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+LS8_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ls8")
+sys.path.insert(0, LS8_DIR)
+
+from cpu import *
+from output import CaptureOutput, NullOutput
+from runner import ENGINES
+
+# example programs that never halt on their own--they spin waiting
+# for interrupts--so there's nothing to time
+SKIP = {"interrupts.ls8", "keyboard.ls8"}
+
+
+def assemble(program):
+    """
+    Turn a list of opcodes, operands and "label:" / "label" strings into
+    bytes. A string ending in ":" marks an address, any other string is
+    replaced with the address of that label.
+    """
+
+    labels = {}
+    address = 0
+    for item in program:
+        if isinstance(item, str) and item.endswith(":"):
+            labels[item[:-1]] = address
+        else:
+            address += 1
+
+    return bytes(
+        labels[item] if isinstance(item, str) else item
+        for item in program
+        if not (isinstance(item, str) and item.endswith(":"))
+    )
+
+
+# Generated workloads. Counters count up with INC and wrap from 255 back
+# to 0, so comparing against R2/R4 = 0 loops 256 times. R5 is the interrupt
+# mask, so it's never given an odd value that would unmask the timer.
+
+# nested CMP/JNE loops: 65536 trips round the inner loop
+CMP_JNE_LOOP = assemble([
+    LDI, 2, 0,
+    LDI, 3, "inner",
+    LDI, 1, "outer",
+    "outer:",
+    INC, 4,
+    "inner:",
+    INC, 0,
+    CMP, 0, 2,
+    JNE, 3,
+    CMP, 4, 2,
+    JNE, 1,
+    HLT,
+])
+
+# recurse 100 CALLs deep and back out again, 256 times
+CALL_RET_RECURSION = assemble([
+    LDI, 1, "sub",
+    LDI, 2, 0,
+    LDI, 5, "loop",
+    LDI, 6, "done",
+    "loop:",
+    LDI, 0, 100,
+    CALL, 1,
+    INC, 4,
+    CMP, 4, 2,
+    JNE, 5,
+    HLT,
+    "sub:",
+    DEC, 0,
+    CMP, 0, 2,
+    JEQ, 6,
+    CALL, 1,
+    "done:",
+    RET,
+])
+
+# three PUSHes and three POPs per trip, 65536 trips
+PUSH_POP = assemble([
+    LDI, 0, "inner",
+    LDI, 1, "outer",
+    LDI, 4, 0,
+    "outer:",
+    INC, 6,
+    "inner:",
+    PUSH, 0,
+    PUSH, 1,
+    PUSH, 2,
+    POP, 2,
+    POP, 1,
+    POP, 0,
+    INC, 3,
+    CMP, 3, 4,
+    JNE, 0,
+    CMP, 6, 4,
+    JNE, 1,
+    HLT,
+])
+
+GENERATED = {
+    "gen/cmp_jne_loop": CMP_JNE_LOOP,
+    "gen/call_ret_recursion": CALL_RET_RECURSION,
+    "gen/push_pop": PUSH_POP,
+}
+
+# programs too short to time that the engines have disagreed on, run only
+# by --check
+
+# CALL to itself: every return address is pushed further down RAM until
+# one lands on the CALL's own operand and turns it into garbage
+CALL_OVER_ITSELF = assemble([
+    LDI, 1, "call",
+    "call:",
+    CALL, 1,
+])
+
+CHECKS = {
+    "check/call_over_itself": CALL_OVER_ITSELF,
+}
+
+
+def workloads():
+    """All (name, loader) pairs to benchmark, where loader(cpu) loads one."""
+
+    result = []
+
+    for directory in ("examples", "my_programs"):
+        for filename in sorted(glob.glob(os.path.join(LS8_DIR, directory, "*.ls8"))):
+            if os.path.basename(filename) in SKIP:
+                continue
+
+            name = f"{directory}/{os.path.basename(filename)}"
+            result.append((name, lambda cpu, f=filename: cpu.load(f)))
+
+    for name, program in GENERATED.items():
+        result.append((name, lambda cpu, p=program: cpu.ram_write_block(0, p)))
+
+    return result
+
+
+def final_state(engine, loader):
+    """Everything a run of a workload leaves behind, to compare engines."""
+
+    cpu = ENGINES[engine](CaptureOutput())
+    loader(cpu)
+    result = cpu.run()
+
+    return (result.status, result.error, result.instructions, cpu.pc, cpu.fl,
+            bytes(cpu.ram), bytes(cpu.reg), cpu.output.getvalue())
+
+
+def check(engines):
+    """
+    Run every workload, and every program in CHECKS, on each engine.
+    Returns the workloads where an engine ended up somewhere different
+    from the first one.
+    """
+
+    programs = workloads() + [
+        (name, lambda cpu, p=program: cpu.ram_write_block(0, p))
+        for name, program in CHECKS.items()
+    ]
+    mismatches = []
+
+    for name, loader in programs:
+        expected = final_state(engines[0], loader)
+        for engine in engines[1:]:
+            if final_state(engine, loader) != expected:
+                mismatches.append(f"{name}: {engine} differs from {engines[0]}")
+
+    return mismatches
+
+
+def run_once(engine, loader):
+    """Run a workload once, returning (seconds, instructions, status)."""
+
+    cpu = ENGINES[engine](NullOutput())
+    loader(cpu)
+
+    start = time.perf_counter()
+    try:
+        status = cpu.run().status
+    except Exception as e:
+        status = f"crashed: {e!r}"
+    elapsed = time.perf_counter() - start
+
+    return elapsed, cpu.instruction_count, status
+
+
+def peak_memory(engine, loader):
+    """Peak bytes allocated while loading and running a workload."""
+
+    tracemalloc.start()
+    try:
+        cpu = ENGINES[engine](NullOutput())
+        loader(cpu)
+        try:
+            cpu.run()
+        except Exception:
+            pass
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench(engines, repeat, pattern=None):
+    """Benchmark every workload on every engine, best time of `repeat` runs."""
+
+    results = []
+
+    for name, loader in workloads():
+        if pattern is not None and pattern not in name:
+            continue
+
+        for engine in engines:
+            times = []
+            for _ in range(repeat):
+                elapsed, instructions, status = run_once(engine, loader)
+                times.append(elapsed)
+
+            best = min(times)
+
+            results.append({
+                "workload": name,
+                "engine": engine,
+                "status": status,
+                "instructions": instructions,
+                "seconds": best,
+                "mips": instructions / best / 1e6 if best > 0 else 0.0,
+                "peak_bytes": peak_memory(engine, loader),
+            })
+
+    return results
+
+
+def print_results(results, out=sys.stdout):
+    print(f"{'workload':<32} {'engine':<7} {'instructions':>12} "
+          f"{'seconds':>10} {'MIPS':>8} {'peak KiB':>9}", file=out)
+
+    for r in results:
+        flag = "" if r["status"] == "halted" else f"  ({r['status']})"
+        print(f"{r['workload']:<32} {r['engine']:<7} {r['instructions']:>12} "
+              f"{r['seconds']:>10.6f} {r['mips']:>8.3f} "
+              f"{r['peak_bytes'] / 1024:>9.1f}{flag}", file=out)
+
+
+def compare(results, baseline, tolerance, min_instructions):
+    """
+    Compare MIPS against a baseline run. Returns a list of regressions,
+    ignoring workloads too short to time reliably.
+    """
+
+    previous = {(r["workload"], r["engine"]): r for r in baseline["results"]}
+    regressions = []
+
+    for r in results:
+        old = previous.get((r["workload"], r["engine"]))
+        if old is None or r["instructions"] < min_instructions:
+            continue
+
+        if r["mips"] < old["mips"] * (1 - tolerance):
+            regressions.append(
+                f"{r['workload']} [{r['engine']}]: "
+                f"{old['mips']:.3f} -> {r['mips']:.3f} MIPS"
+            )
+
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the LS-8 emulator.")
+    parser.add_argument("--engine", action="append", choices=ENGINES,
+                        help="engine to benchmark (repeatable, default: all)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per workload; the best time is kept")
+    parser.add_argument("--filter", metavar="TEXT",
+                        help="only run workloads whose name contains TEXT")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare against earlier JSON results and fail "
+                             "on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed MIPS drop against the baseline "
+                             "(default 0.10, i.e. 10%%)")
+    parser.add_argument("--min-instructions", type=int, default=10000,
+                        help="ignore workloads shorter than this when "
+                             "comparing against the baseline")
+    parser.add_argument("--check", action="store_true",
+                        help="don't time anything, just check the engines "
+                             "all end every workload in the same state")
+    args = parser.parse_args(argv[1:])
+
+    engines = args.engine or list(ENGINES)
+
+    if args.check:
+        mismatches = check(engines)
+        for m in mismatches:
+            print(m, file=sys.stderr)
+        if mismatches:
+            return 1
+        print(f"all engines agree on {len(workloads()) + len(CHECKS)} workloads")
+        return 0
+    results = bench(engines, args.repeat, args.filter)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.tolerance,
+                              args.min_instructions)
+
+        if regressions:
+            print("\nRegressions:", file=sys.stderr)
+            for r in regressions:
+                print(f"  {r}", file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
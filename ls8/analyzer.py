@@ -0,0 +1,649 @@
+#!/usr/bin/env python3
+
+"""
+Static analyzer for LS-8 programs. Disassembles a program, recovers its
+control-flow graph by following the addresses LDI loads into jump and call
+registers, and works out the worst-case stack depth, without running it.
+
+Usage: analyzer.py program.ls8 [--json]
+
+Prints the disassembly, basic blocks and any warnings: infinite loops, jumps
+whose targets can't be worked out, and stacks that could grow down into the
+program. Exits with status 1 if there are warnings.
+"""
+
+import argparse
+import json
+import sys
+from cpu import *
+
+# the stack starts here and grows down
+STACK_TOP = 0xf4
+
+# an interrupt pushes PC, FL and R0-R6 before its handler runs
+INTERRUPT_FRAME = 9
+
+# deeper than this, and the stack has certainly run over everything
+MAX_DEPTH = 256
+
+# conditional jumps: taken or fall through
+CONDITIONAL_JUMPS = set(BRANCH_TAKEN)
+
+# these end a path through a routine
+ROUTINE_ENDS = {HLT, RET, IRET}
+
+# a basic block ends after any of these
+BLOCK_ENDS = {JMP, CALL, RET, IRET, HLT} | CONDITIONAL_JUMPS
+
+
+class Instruction:
+    """One decoded instruction."""
+
+    def __init__(self, address, ir, operand_a, operand_b):
+        self.address = address
+        self.ir = ir
+        self.length = (ir >> 6) + 1
+        self.operands = (operand_a, operand_b)[:self.length - 1]
+        self.name = OPCODE_NAMES.get(ir)
+
+    def text(self):
+        """The instruction as assembly source."""
+
+        if self.name is None:
+            return f"DB {self.ir:#04x}"
+
+        if self.ir == LDI:
+            return f"LDI R{self.operands[0]},{self.operands[1]:#04x}"
+
+        return " ".join(
+            [self.name] + [",".join(f"R{r}" for r in self.operands)]
+        ).strip()
+
+
+class Block:
+    """A basic block: straight-line instructions with one way in."""
+
+    def __init__(self, start):
+        self.start = start
+        self.instructions = []
+
+        # addresses of the blocks control can go to next
+        self.successors = []
+
+    def to_dict(self):
+        return {
+            "start": self.start,
+            "instructions": [i.address for i in self.instructions],
+            "successors": self.successors,
+        }
+
+
+class Analysis:
+    """
+    The results of analyzing a program. After analyze():
+
+    * instructions: address -> Instruction, for every reachable instruction
+    * edges: address -> addresses control can go to next (CALLs continue
+      after the call; the subroutine is in calls)
+    * calls: address of each CALL -> the subroutine it calls
+    * blocks: start address -> Block
+    * routines: entry address -> the addresses reachable from it, for the
+      program (entry 0), every subroutine and every interrupt handler
+    * handlers: interrupt handler entry addresses
+    * stack_depths: entry address -> worst-case bytes of stack the routine
+      uses, including what it calls, or None if there's no bound
+    * max_stack_depth: worst case for the whole program, or None
+    * key_reads: addresses of LDs that read the key latch
+    * key_unmasks: addresses of writes to IM that may unmask the keyboard
+    * warnings: human-readable problems found
+    """
+
+    def __init__(self, ram, symbols=None):
+        self.ram = bytes(ram)
+        self.symbols = symbols or {}
+
+        # routine entry -> the registers it (or anything it calls) may
+        # change. Routines not in here may change any register
+        self.clobbers = {}
+
+        # routine entry -> register values known on every call to it
+        self.entry_regs = {}
+
+        self.reset()
+
+    def reset(self):
+        self.instructions = {}
+        self.edges = {}
+        self.calls = {}
+        self.blocks = {}
+        self.routines = {}
+        self.handlers = []
+        self.stack_depths = {}
+        self.max_stack_depth = None
+        self.warnings = []
+
+        # routine entry -> deepest local stack depth, and
+        # [(call address, depth at the call, subroutine)]
+        self.local_depths = {}
+        self.call_sites = {}
+
+        # routines whose stack grows in a loop
+        self.unbounded = set()
+
+        # routine entry -> registers it writes itself, and whether it
+        # makes a call we can't follow
+        self.writes = {}
+        self.unknown_calls = set()
+
+        # LDs known to read the key latch, and writes to IM that may
+        # unmask the keyboard interrupt
+        self.key_reads = set()
+        self.key_unmasks = set()
+
+        # subroutine -> register values at each call to it
+        self.call_regs = {}
+
+    def name(self, address):
+        # label name if we have symbols, else the address in hex
+        for label, label_address in self.symbols.items():
+            if label_address == address:
+                return label
+        return f"{address:#04x}"
+
+    def warn(self, message):
+        if message not in self.warnings:
+            self.warnings.append(message)
+
+    def run(self):
+        # every CALL we can follow tells us what the subroutine leaves
+        # alone and what it's called with, which can resolve more calls.
+        # Go round until nothing new turns up
+        for _ in range(8):
+            self.trace_all()
+
+            clobbers = self.summarize_clobbers()
+            entry_regs = self.summarize_entry_regs()
+            if clobbers == self.clobbers and entry_regs == self.entry_regs:
+                break
+
+            self.clobbers = clobbers
+            self.entry_regs = entry_regs
+            self.reset()
+
+        self.build_blocks()
+        self.find_infinite_loops()
+        self.find_stack_depths()
+
+        return self
+
+    def trace_all(self):
+        # the program starts at 0. Subroutines and interrupt handlers are
+        # found along the way and analyzed in turn
+        pending = [0]
+
+        while pending:
+            entry = pending.pop()
+            if entry in self.routines:
+                continue
+
+            for found in self.trace_routine(entry):
+                if found not in self.routines:
+                    pending.append(found)
+
+    def summarize_clobbers(self):
+        # what each routine writes, plus what everything it calls writes
+        clobbers = {}
+
+        for entry in self.routines:
+            if entry in self.unknown_calls:
+                clobbers[entry] = set(range(7))
+            else:
+                clobbers[entry] = set(self.writes[entry])
+
+        changed = True
+        while changed:
+            changed = False
+            for entry in self.routines:
+                for _, _, target in self.call_sites[entry]:
+                    extra = clobbers.get(target, set(range(7))) - clobbers[entry]
+                    if extra:
+                        clobbers[entry] |= extra
+                        changed = True
+
+        return clobbers
+
+    def summarize_entry_regs(self):
+        # the register values every call to a subroutine agrees on. The
+        # program and interrupt handlers can start with anything
+        entry_regs = {}
+
+        for target, calls in self.call_regs.items():
+            if target == 0 or target in self.handlers:
+                continue
+
+            regs = calls[0]
+            for other in calls[1:]:
+                regs = tuple(r if r == o else None for r, o in zip(regs, other))
+            entry_regs[target] = regs
+
+        return entry_regs
+
+    def decode(self, address):
+        instruction = self.instructions.get(address)
+
+        if instruction is None:
+            ram = self.ram
+            instruction = Instruction(
+                address, ram[address], ram[(address + 1) & 0xff],
+                ram[(address + 2) & 0xff]
+            )
+            self.instructions[address] = instruction
+
+        return instruction
+
+    def trace_routine(self, entry):
+        """
+        Follow every path from entry, tracking which registers hold known
+        constants and how deep the stack is. Returns the subroutines and
+        interrupt handlers it leads to.
+        """
+
+        # address -> (register values, None where unknown; stack depth)
+        states = {entry: (self.entry_regs.get(entry, (None,) * 8), 0)}
+        worklist = [entry]
+        found = []
+
+        local_depth = 0
+        call_sites = {}
+        writes = set()
+
+        while worklist:
+            address = worklist.pop()
+            regs, depth = states[address]
+            local_depth = max(local_depth, depth)
+
+            instruction = self.decode(address)
+            ir = instruction.ir
+
+            if instruction.name is None:
+                self.warn(f"unknown instruction {ir:#04x} at {self.name(address)}")
+                self.edges[address] = []
+                continue
+
+            # the CPU faults on a register past R7, so the path ends here
+            if bad_registers(ir, self.ram[(address + 1) & 0xff],
+                             self.ram[(address + 2) & 0xff]):
+                self.warn(f"bad register operand for {instruction.name} "
+                          f"at {self.name(address)}")
+                self.edges[address] = []
+                continue
+
+            next_address = address + instruction.length
+            operand_a = instruction.operands[0] if instruction.operands else None
+            regs = list(regs)
+            successors = []
+
+            if ir == LDI:
+                regs[operand_a] = instruction.operands[1]
+                writes.add(operand_a)
+                successors.append(next_address)
+
+            elif ir in (JMP, CALL) or ir in CONDITIONAL_JUMPS:
+                target = regs[operand_a]
+
+                if target is None:
+                    self.warn(f"can't tell where {instruction.name} at "
+                              f"{self.name(address)} goes")
+
+                if ir == CALL:
+                    if target is not None:
+                        call_sites[address] = (depth, target)
+                        self.calls[address] = target
+                        self.call_regs.setdefault(target, []).append(tuple(regs))
+                        found.append(target)
+                    else:
+                        self.unknown_calls.add(entry)
+
+                    # assume the subroutine returns, having changed the
+                    # registers it's known to change--or any of them
+                    clobbered = self.clobbers.get(target, range(7))
+                    for r in clobbered:
+                        regs[r] = None
+                    successors.append(next_address)
+
+                else:
+                    if target is not None:
+                        successors.append(target)
+                    if ir != JMP:
+                        successors.append(next_address)
+
+            elif ir in ROUTINE_ENDS:
+                pass
+
+            elif ir == PUSH:
+                depth += 1
+                successors.append(next_address)
+
+            elif ir == POP:
+                depth -= 1
+                regs[operand_a] = None
+                writes.add(operand_a)
+                successors.append(next_address)
+
+            elif ir == ST:
+                address_value = regs[operand_a]
+                value = regs[instruction.operands[1]]
+
+                # writing a handler's address into the vector table
+                if (address_value is not None and value is not None
+                        and VECTOR_TABLE <= address_value <= 0xff):
+                    if value not in self.handlers:
+                        self.handlers.append(value)
+                    found.append(value)
+
+                successors.append(next_address)
+
+            elif ALU_OPS[ir] is not None:
+                # fold constants through the ALU where both are known
+                if ir != CMP:
+                    writes.add(operand_a)
+                    a = regs[operand_a]
+                    b = regs[instruction.operands[1]] if instruction.length == 3 else a
+                    try:
+                        regs[operand_a] = None if a is None or b is None else ALU_OPS[ir](a, b)
+                    except ZeroDivisionError:
+                        regs[operand_a] = None
+                successors.append(next_address)
+
+            else:
+                # LD, PRN, PRA, INT
+                if ir == LD:
+                    if regs[instruction.operands[1]] == KEY_PRESSED:
+                        self.key_reads.add(address)
+                    regs[operand_a] = None
+                    writes.add(operand_a)
+                successors.append(next_address)
+
+            # a write to IM unmasks the keyboard unless its value is known
+            # to leave I1 off
+            wrote_im = operand_a == IM and (
+                ir in (LDI, LD, POP) or (ALU_OPS[ir] is not None and ir != CMP))
+            if wrote_im and (regs[IM] is None or regs[IM] & KEYBOARD_INTERRUPT):
+                self.key_unmasks.add(address)
+
+            successors = [s & 0xff for s in successors]
+            self.edges[address] = successors
+
+            if depth > MAX_DEPTH:
+                # pushing in a loop--no point going round again
+                self.unbounded.add(entry)
+                self.warn(f"stack grows without bound at {self.name(address)}")
+                continue
+
+            # merge what we know into each successor, and go (back) there
+            # if that changed anything
+            state = (tuple(regs), depth)
+            for successor in successors:
+                old = states.get(successor)
+
+                if old is None:
+                    new = state
+                else:
+                    old_regs, old_depth = old
+                    new = (
+                        tuple(r if r == o else None for r, o in zip(regs, old_regs)),
+                        max(depth, old_depth),
+                    )
+
+                if new != old:
+                    states[successor] = new
+                    worklist.append(successor)
+
+        self.routines[entry] = sorted(states)
+        self.writes[entry] = writes
+        self.local_depths[entry] = local_depth
+        self.call_sites[entry] = [
+            (address, depth, target) for address, (depth, target) in call_sites.items()
+        ]
+
+        return found
+
+    def uses_keyboard(self):
+        """
+        Whether the program can see the keyboard: it may unmask the keyboard
+        interrupt, or reads the key latch at KEY_PRESSED.
+        """
+
+        return bool(self.key_reads or self.key_unmasks)
+
+    def build_blocks(self):
+        # a block starts at every entry point and jump target, and after
+        # anything that ends a block
+        leaders = set(self.routines)
+
+        for address, successors in self.edges.items():
+            instruction = self.instructions[address]
+            if instruction.ir in BLOCK_ENDS:
+                leaders.update(successors)
+
+        for start in sorted(leaders):
+            if start not in self.instructions:
+                continue
+
+            block = Block(start)
+            address = start
+
+            while True:
+                instruction = self.instructions[address]
+                block.instructions.append(instruction)
+
+                successors = self.edges.get(address, [])
+
+                if (instruction.ir in BLOCK_ENDS or len(successors) != 1
+                        or successors[0] in leaders
+                        or successors[0] not in self.instructions):
+                    block.successors = successors
+                    break
+
+                address = successors[0]
+
+            self.blocks[start] = block
+
+    def find_infinite_loops(self):
+        """
+        Warn about loops with no way out: instructions in a routine from
+        which no HLT, RET or IRET--or jump we can't follow--can be reached.
+        """
+
+        for entry, addresses in self.routines.items():
+            addresses = set(addresses)
+
+            # work backwards from every way out of the routine
+            predecessors = {address: [] for address in addresses}
+            exits = []
+
+            for address in addresses:
+                instruction = self.instructions[address]
+                successors = self.edges.get(address, [])
+
+                for successor in successors:
+                    if successor in predecessors:
+                        predecessors[successor].append(address)
+
+                unresolved = (
+                    instruction.ir in (JMP, CALL) or instruction.ir in CONDITIONAL_JUMPS
+                ) and not successors
+                if (instruction.name is None or instruction.ir in ROUTINE_ENDS
+                        or unresolved or (instruction.ir in CONDITIONAL_JUMPS
+                                          and len(successors) < 2)):
+                    exits.append(address)
+
+            can_exit = set(exits)
+            while exits:
+                for predecessor in predecessors[exits.pop()]:
+                    if predecessor not in can_exit:
+                        can_exit.add(predecessor)
+                        exits.append(predecessor)
+
+            # leave out the straight-line code leading into the loop: drop
+            # anything nothing else stuck leads to, until only loops remain
+            stuck = addresses - can_exit
+            while True:
+                entering = {
+                    address for address in stuck
+                    if not any(p in stuck for p in predecessors[address])
+                }
+                if not entering:
+                    break
+                stuck -= entering
+
+            stuck = sorted(stuck)
+            if stuck:
+                where = ", ".join(self.name(a) for a in stuck)
+                message = f"infinite loop at {where}"
+                if self.handlers and entry == 0:
+                    message += " (only an interrupt can leave it)"
+                self.warn(message)
+
+    def find_stack_depths(self):
+        # worst case for each routine: its own pushes, plus the deepest
+        # thing it calls at the depth it calls it from
+        visiting = set()
+
+        def depth_of(entry):
+            if entry in self.stack_depths:
+                return self.stack_depths[entry]
+
+            if entry in self.unbounded:
+                # pushing in a loop
+                self.stack_depths[entry] = None
+                return None
+
+            if entry in visiting:
+                self.warn(f"{self.name(entry)} is recursive, so its "
+                          f"stack depth has no bound")
+                return None
+
+            visiting.add(entry)
+            worst = self.local_depths[entry]
+
+            for address, depth, target in self.call_sites[entry]:
+                callee = depth_of(target)
+                if callee is None:
+                    worst = None
+                    break
+                # the return address, then the subroutine's own stack
+                worst = max(worst, depth + 1 + callee)
+
+            visiting.discard(entry)
+            self.stack_depths[entry] = worst
+            return worst
+
+        for entry in self.routines:
+            depth_of(entry)
+
+        worst = self.stack_depths.get(0)
+
+        # an interrupt can land at the deepest point of the program
+        for handler in self.handlers:
+            handler_depth = self.stack_depths.get(handler)
+            if worst is None or handler_depth is None:
+                worst = None
+                break
+            worst = max(worst, self.stack_depths[0] + INTERRUPT_FRAME + handler_depth)
+
+        self.max_stack_depth = worst
+
+        # the program ends at the last reachable instruction or the last
+        # nonzero byte (data), whichever is further
+        program_end = max(
+            [i.address + i.length for i in self.instructions.values()]
+            + [a + 1 for a in range(STACK_TOP) if self.ram[a]]
+        )
+
+        if worst is None:
+            self.warn(f"stack overflow: the stack has no bound, and will run "
+                      f"down into the program (which ends at {program_end:#04x})")
+        elif STACK_TOP - worst < program_end:
+            self.warn(f"stack overflow: the stack can reach "
+                      f"{STACK_TOP - worst:#04x}, inside the program "
+                      f"(which ends at {program_end:#04x})")
+
+    def to_dict(self):
+        return {
+            "instructions": {
+                address: instruction.text()
+                for address, instruction in sorted(self.instructions.items())
+            },
+            "blocks": [block.to_dict() for _, block in sorted(self.blocks.items())],
+            "calls": self.calls,
+            "handlers": self.handlers,
+            "stack_depths": self.stack_depths,
+            "max_stack_depth": self.max_stack_depth,
+            "warnings": self.warnings,
+        }
+
+    def report(self, file=sys.stdout):
+        """Print the disassembly, blocks and warnings."""
+
+        labels = {address: label for label, address in self.symbols.items()}
+
+        print("Disassembly:", file=file)
+        for address, instruction in sorted(self.instructions.items()):
+            if address in labels:
+                print(f"{labels[address]}:", file=file)
+            print(f"  {address:02x}: {instruction.text()}", file=file)
+
+        print("\nBlocks:", file=file)
+        for start, block in sorted(self.blocks.items()):
+            successors = ", ".join(self.name(s) for s in block.successors) or "-"
+            print(f"  {self.name(start):<12} {len(block.instructions):>3} "
+                  f"instructions  -> {successors}", file=file)
+
+        print("\nStack depth:", file=file)
+        for entry, depth in sorted(self.stack_depths.items()):
+            kind = ("program" if entry == 0 else
+                    "handler" if entry in self.handlers else "subroutine")
+            shown = "unbounded" if depth is None else depth
+            print(f"  {self.name(entry):<12} {kind:<10} {shown}", file=file)
+
+        worst = "unbounded" if self.max_stack_depth is None else self.max_stack_depth
+        print(f"  worst case: {worst}", file=file)
+
+        if self.warnings:
+            print("\nWarnings:", file=file)
+            for warning in self.warnings:
+                print(f"  {warning}", file=file)
+
+
+def analyze(ram, symbols=None):
+    """Analyze a 256-byte memory image, returning an Analysis."""
+
+    return Analysis(ram, symbols).run()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Statically analyze an LS-8 program.")
+    parser.add_argument("program", metavar="program.ls8")
+    parser.add_argument("--json", action="store_true",
+                        help="print the analysis as JSON")
+    args = parser.parse_args(argv[1:])
+
+    # load it exactly as the emulator would
+    cpu = CPU()
+    cpu.load(args.program)
+
+    analysis = analyze(cpu.ram_dump(), cpu.symbols)
+
+    if args.json:
+        json.dump(analysis.to_dict(), sys.stdout, indent=2)
+        print()
+    else:
+        analysis.report()
+
+    return 1 if analysis.warnings else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+
+"""
+Vectorized CPU that runs many LS-8 machines at once.
+
+Usage: batch.py program.ls8 [program.ls8 ...]
+
+Runs the programs together in one batch and each on its own CPU, and
+prints any program whose batch lane ended up different.
+"""
+
+import math
+import sys
+import numpy as np
+from cpu import *
+from output import CaptureOutput
+
+
+class BatchCPU:
+    """
+    Runs N independent LS-8 machines in lockstep. RAM, registers, PC and FL
+    for every machine (lane) are held as NumPy arrays, and each step fetches,
+    decodes and executes one instruction on every running lane at once.
+
+    Lanes that take different branches simply end up at different PCs--each
+    opcode is applied to the lanes that fetched it, so divergence costs one
+    extra pass per distinct opcode in the step rather than per lane.
+    """
+
+    def __init__(self, n):
+        """Construct a batch of n CPUs, all in their power-on state."""
+
+        self.n = n
+
+        # one row of RAM and registers per lane
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.reg = np.zeros((n, 8), dtype=np.uint8)
+
+        # Program Counter and flags (00000LGE) per lane
+        self.pc = np.zeros(n, dtype=np.int64)
+        self.fl = np.zeros(n, dtype=np.uint8)
+
+        # set register 7 to point to the top of the stack
+        self.reg[:, 7] = 0xf4
+
+        # which lanes are still executing, and which stopped on an error
+        self.running = np.zeros(n, dtype=bool)
+        self.faulted = np.zeros(n, dtype=bool)
+
+        # cleared per lane while an interrupt handler runs. Lanes have no
+        # timer or keyboard, so only the program raises interrupts: with
+        # INT, or by setting bits in IS itself
+        self.interrupts_enabled = np.ones(n, dtype=bool)
+
+        # steps run so far, to check for interrupts as often as CPU does
+        self.steps = 0
+
+        # each lane's fault register: the FAULT_* code it stopped on (0 if
+        # none) and the message CPUFault would have given
+        self.fault_code = np.zeros(n, dtype=np.uint8)
+        self.errors = [None] * n
+
+        # what each lane has printed, one string per print
+        self.output = [[] for _ in range(n)]
+
+        # branch table for instruction set. Each handler gets the lanes that
+        # fetched the opcode plus their PCs and operands, and returns the
+        # lanes' new PCs if the instruction sets the PC itself
+        self.instruction_set = {}
+        self.instruction_set[LDI] = self.LDI
+        self.instruction_set[PRN] = self.PRN
+        self.instruction_set[PRA] = self.PRA
+        self.instruction_set[HLT] = self.HLT
+        self.instruction_set[PUSH] = self.PUSH
+        self.instruction_set[POP] = self.POP
+        self.instruction_set[CMP] = self.CMP
+        self.instruction_set[JMP] = self.JMP
+        self.instruction_set[JEQ] = self.branch
+        self.instruction_set[JNE] = self.branch
+        self.instruction_set[JGT] = self.branch
+        self.instruction_set[JLT] = self.branch
+        self.instruction_set[JGE] = self.branch
+        self.instruction_set[JLE] = self.branch
+        self.instruction_set[CALL] = self.CALL
+        self.instruction_set[RET] = self.RET
+        self.instruction_set[LD] = self.LD
+        self.instruction_set[ST] = self.ST
+        self.instruction_set[INT] = self.INT
+        self.instruction_set[IRET] = self.IRET
+
+        # the register-to-register ALU ops all share one handler
+        for op in ALU_OPS_VECTORIZED:
+            self.instruction_set[op] = self.alu
+
+        # which opcodes are in the instruction set, to check every lane's
+        # at once
+        self.known = np.zeros(256, dtype=bool)
+        self.known[list(self.instruction_set)] = True
+
+    def load(self, lane, program):
+        """Load a program (a sequence of byte values) into one lane's RAM."""
+
+        self.ram[lane, :len(program)] = np.frombuffer(bytes(program), dtype=np.uint8)
+        self.running[lane] = True
+
+    def load_file(self, lane, filename):
+        """Load a .ls8 file into one lane, the same way CPU.load does."""
+
+        cpu = CPU()
+        cpu.load(filename)
+        self.ram[lane] = np.frombuffer(cpu.ram_dump(), dtype=np.uint8)
+        self.running[lane] = True
+
+    def printed(self, lane):
+        """Everything the lane printed, exactly as CPU would print it."""
+
+        return "".join(self.output[lane])
+
+    def fault(self, lanes, fault_class, pc, ops=None):
+        # stop these lanes for good, noting the fault the single CPU
+        # would have raised for each of them. Only PCOutOfRange has
+        # no opcode
+        self.running[lanes] = False
+        self.faulted[lanes] = True
+        self.fault_code[lanes] = fault_class.code
+
+        for i, (lane, address) in enumerate(zip(lanes.tolist(), pc.tolist())):
+            if ops is None:
+                self.errors[lane] = str(fault_class(address))
+            else:
+                self.errors[lane] = str(fault_class(address, int(ops[i])))
+
+    def step(self):
+        """
+        Execute one instruction on every running lane. Returns False once
+        no lane is running any more.
+        """
+
+        lanes = np.nonzero(self.running)[0]
+        if lanes.size == 0:
+            return False
+
+        # take any pending unmasked interrupt at the start of every
+        # INTERRUPT_CHECK_INTERVAL steps, as CPU.run_slice() does
+        if self.steps % INTERRUPT_CHECK_INTERVAL == 0:
+            self.pc[lanes] = self.interrupt(lanes, self.pc[lanes])
+        self.steps += 1
+
+        # a lane that ran off the top of RAM can't fetch anything
+        off_the_end = self.pc[lanes] > 0xff
+        if off_the_end.any():
+            self.fault(lanes[off_the_end], PCOutOfRange, self.pc[lanes[off_the_end]])
+            lanes = lanes[~off_the_end]
+
+        pc = self.pc[lanes]
+
+        # fetch the opcode and both operand bytes for every lane
+        ir = self.ram[lanes, pc]
+        operand_a = self.ram[lanes, (pc + 1) & 0xff]
+        operand_b = self.ram[lanes, (pc + 2) & 0xff]
+
+        # by default every lane moves past its instruction and operands
+        next_pc = pc + (ir >> 6) + 1
+
+        # register operands must name one of the 8 registers. LDI's
+        # second operand is an immediate value, not a register. An unknown
+        # opcode has no registers--like CPU.decode, it faults as unknown
+        reg_operands = (ir >> 6).astype(np.int64)
+        reg_operands[ir == LDI] = 1
+        bad = ((reg_operands >= 1) & (operand_a > 7)) | ((reg_operands >= 2) & (operand_b > 7))
+        bad &= self.known[ir]
+        if bad.any():
+            self.fault(lanes[bad], BadRegister, pc[bad], ir[bad])
+
+        # run each opcode present in this step on the lanes that fetched it
+        for op in np.unique(ir[~bad]).tolist():
+            select = (ir == op) & ~bad
+
+            handler = self.instruction_set.get(op)
+            if handler is None:
+                self.fault(lanes[select], UnknownInstruction, pc[select], ir[select])
+                continue
+
+            jumped = handler(op, lanes[select], pc[select], operand_a[select], operand_b[select])
+
+            if jumped is not None:
+                next_pc[select] = jumped
+
+        # faulted lanes keep the PC they stopped at
+        ok = ~self.faulted[lanes]
+        self.pc[lanes[ok]] = next_pc[ok]
+
+        return True
+
+    def run(self, max_steps=None):
+        """Step every lane until they have all halted (or max_steps ran out)."""
+
+        steps = 0
+        while self.step():
+            steps += 1
+            if max_steps is not None and steps >= max_steps:
+                break
+
+        return steps
+
+    def LDI(self, op, lanes, pc, reg_num, value):
+        self.reg[lanes, reg_num] = value
+
+    def PRN(self, op, lanes, pc, reg_num, _):
+        values = self.reg[lanes, reg_num]
+        for lane, value in zip(lanes.tolist(), values.tolist()):
+            self.output[lane].append(f"{value}\n")
+
+    def PRA(self, op, lanes, pc, reg_num, _):
+        values = self.reg[lanes, reg_num]
+        for lane, value in zip(lanes.tolist(), values.tolist()):
+            self.output[lane].append(chr(value))
+
+    def HLT(self, op, lanes, *_):
+        self.running[lanes] = False
+
+    def alu(self, op, lanes, pc, reg_a, reg_b):
+        # NOT, INC and DEC only have the one operand
+        if op >> 6 == 1:
+            reg_b = reg_a
+
+        val_a = self.reg[lanes, reg_a].astype(np.int64)
+        val_b = self.reg[lanes, reg_b].astype(np.int64)
+
+        # division by 0 stops just the lanes that attempted it
+        if op == DIV or op == MOD:
+            zero = val_b == 0
+            if zero.any():
+                self.fault(lanes[zero], DivisionByZero, pc[zero], np.full(int(zero.sum()), op))
+                lanes, reg_a = lanes[~zero], reg_a[~zero]
+                val_a, val_b = val_a[~zero], val_b[~zero]
+
+        self.reg[lanes, reg_a] = ALU_OPS_VECTORIZED[op](val_a, val_b) & 0xff
+
+    def CMP(self, op, lanes, pc, reg_a, reg_b):
+        val_a = self.reg[lanes, reg_a]
+        val_b = self.reg[lanes, reg_b]
+        # 00000LGE less,greater,equal
+        self.fl[lanes] = np.where(val_a == val_b, 0b001, np.where(val_a > val_b, 0b010, 0b100))
+
+    def PUSH(self, op, lanes, pc, reg_num, _):
+        SP = 7
+        # decrement SP, then store the register (read after the decrement,
+        # so PUSH R7 pushes the new SP just like CPU.PUSH)
+        self.reg[lanes, SP] -= 1
+        self.ram[lanes, self.reg[lanes, SP]] = self.reg[lanes, reg_num]
+
+    def POP(self, op, lanes, pc, reg_num, _):
+        SP = 7
+        self.reg[lanes, reg_num] = self.ram[lanes, self.reg[lanes, SP]]
+        self.reg[lanes, SP] += 1
+
+    def JMP(self, op, lanes, pc, reg_num, _):
+        return self.reg[lanes, reg_num]
+
+    def branch(self, op, lanes, pc, reg_num, _):
+        # the conditional jumps all share this handler: each lane's FL
+        # indexes the opcode's precomputed taken/not-taken table
+        taken = BRANCH_TAKEN_VECTORIZED[op][self.fl[lanes]]
+        return np.where(taken, self.reg[lanes, reg_num], pc + 2)
+
+    def CALL(self, op, lanes, pc, reg_num, _):
+        SP = 7
+        # push the return address, then jump
+        self.reg[lanes, SP] -= 1
+        self.ram[lanes, self.reg[lanes, SP]] = (pc + 2) & 0xff
+        return self.reg[lanes, reg_num]
+
+    def RET(self, op, lanes, *_):
+        SP = 7
+        return_addr = self.ram[lanes, self.reg[lanes, SP]]
+        self.reg[lanes, SP] += 1
+        return return_addr
+
+    def LD(self, op, lanes, pc, reg_a, reg_b):
+        # lanes have no devices mapped, so every address is plain RAM
+        self.reg[lanes, reg_a] = self.ram[lanes, self.reg[lanes, reg_b]]
+
+    def ST(self, op, lanes, pc, reg_a, reg_b):
+        self.ram[lanes, self.reg[lanes, reg_a]] = self.reg[lanes, reg_b]
+
+    def push_values(self, lanes, values):
+        SP = 7
+        self.reg[lanes, SP] -= 1
+        self.ram[lanes, self.reg[lanes, SP]] = values
+
+    def pop_values(self, lanes):
+        SP = 7
+        values = self.ram[lanes, self.reg[lanes, SP]]
+        self.reg[lanes, SP] += 1
+        return values
+
+    def INT(self, op, lanes, pc, reg_num, _):
+        # set the interrupt's bit in IS, as CPU.INT does
+        bits = np.left_shift(1, self.reg[lanes, reg_num].astype(np.int64)) & 0xff
+        self.reg[lanes, IS] |= bits.astype(np.uint8)
+
+        # then take it right away on the lanes where it's unmasked, saving
+        # the address after the INT as the PC
+        return self.interrupt(lanes, pc + 2)
+
+    def interrupt(self, lanes, pc):
+        """
+        Take the lowest pending unmasked interrupt on every lane that has
+        one and has interrupts enabled, as CPU.service_interrupts() does.
+        pc is each lane's PC; returns them as they are afterwards.
+        """
+
+        next_pc = pc.copy()
+        pending = self.reg[lanes, IM] & self.reg[lanes, IS]
+        take = (pending != 0) & self.interrupts_enabled[lanes]
+        if not take.any():
+            return next_pc
+
+        taking = lanes[take]
+        pending = pending[take].astype(np.int64)
+
+        # the lowest numbered interrupt wins: isolate its bit and take
+        # its position
+        number = np.log2(pending & -pending).astype(np.int64)
+
+        self.interrupts_enabled[taking] = False
+        self.reg[taking, IS] &= (~(1 << number) & 0xff).astype(np.uint8)
+
+        # save the PC, FL and R0-R6, then jump to the handler
+        self.push_values(taking, next_pc[take] & 0xff)
+        self.push_values(taking, self.fl[taking])
+        for reg_num in range(7):
+            self.push_values(taking, self.reg[taking, reg_num])
+
+        next_pc[take] = self.ram[taking, VECTOR_TABLE + number]
+        return next_pc
+
+    def IRET(self, op, lanes, *_):
+        # R6-R0, then FL, then the PC come back off the stack
+        for reg_num in range(6, -1, -1):
+            self.reg[lanes, reg_num] = self.pop_values(lanes)
+        self.fl[lanes] = self.pop_values(lanes)
+        return_addr = self.pop_values(lanes)
+
+        self.interrupts_enabled[lanes] = True
+        return return_addr
+
+
+# the register-to-register ALU ops over whole arrays of values. Results are
+# masked to 8 bits by BatchCPU.alu
+ALU_OPS_VECTORIZED = {
+    ADD: np.add,
+    SUB: np.subtract,
+    MUL: np.multiply,
+    DIV: np.floor_divide,
+    MOD: np.remainder,
+    AND: np.bitwise_and,
+    OR: np.bitwise_or,
+    XOR: np.bitwise_xor,
+    NOT: lambda a, b: ~a,
+    # shifting a byte by 8 or more always leaves 0, and capping the
+    # count keeps NumPy away from undefined oversized shifts
+    SHL: lambda a, b: np.left_shift(a, np.minimum(b, 8)),
+    SHR: lambda a, b: np.right_shift(a, np.minimum(b, 8)),
+    INC: lambda a, b: a + 1,
+    DEC: lambda a, b: a - 1,
+}
+
+# CPU's branch tables as arrays, so every lane's FL can be looked up at once
+BRANCH_TAKEN_VECTORIZED = {
+    op: np.array(taken, dtype=bool) for op, taken in BRANCH_TAKEN.items()
+}
+
+
+def compare(filenames, max_steps=100000):
+    """
+    Run every program in one batch and again on its own unfused CPU, each for
+    at most max_steps instructions, and return a description of every
+    program whose output, fault, PC, FL, registers or RAM came out
+    different. Empty if they all match.
+
+    The CPU runs without its timer, which lanes don't have, and checks for
+    interrupts exactly every INTERRUPT_CHECK_INTERVAL instructions, as the
+    batch does--CPU.run() checks more often near the end of a budget.
+    """
+
+    batch = BatchCPU(len(filenames))
+    for lane, filename in enumerate(filenames):
+        batch.load_file(lane, filename)
+    batch.run(max_steps)
+
+    differences = []
+
+    for lane, filename in enumerate(filenames):
+        output = CaptureOutput()
+        cpu = CPU(output)
+        cpu.fuse = False
+        cpu.timer_deadline = math.inf
+        cpu.load(filename)
+
+        cpu.running = True
+        try:
+            while cpu.running and cpu.instruction_count < max_steps:
+                cpu.run_slice(min(INTERRUPT_CHECK_INTERVAL,
+                                  max_steps - cpu.instruction_count))
+        except CPUFault:
+            pass
+
+        fault_code = 0 if cpu.fault is None else cpu.fault.code
+
+        checks = [
+            ("output", output.getvalue(), batch.printed(lane)),
+            ("fault", fault_code, int(batch.fault_code[lane])),
+            ("PC", cpu.pc, int(batch.pc[lane])),
+            ("FL", cpu.fl, int(batch.fl[lane])),
+            ("registers", list(cpu.reg), batch.reg[lane].tolist()),
+            ("RAM", list(cpu.ram), batch.ram[lane].tolist()),
+        ]
+
+        for what, expected, got in checks:
+            if expected != got:
+                differences.append(f"{filename}: {what} differs")
+
+    return differences
+
+
+def main(argv):
+    if len(argv) < 2:
+        print("usage: batch.py program.ls8 [program.ls8 ...]", file=sys.stderr)
+        return 1
+
+    differences = compare(argv[1:])
+
+    for difference in differences:
+        print(difference)
+
+    if differences:
+        return 1
+
+    print(f"all {len(argv) - 1} programs match")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,203 @@
+"""On-disk cache of program results, keyed by everything that decides them."""
+
+import hashlib
+import json
+import os
+import time
+from cpu import *
+
+# bump whenever the entry format changes, or anything that changes what a
+# program does, so old entries stop matching
+CACHE_VERSION = b"1"
+
+# default limits on the cache directory
+CACHE_MAX_BYTES = 64 << 20
+CACHE_MAX_ENTRIES = 4096
+
+
+class ResultCache:
+    """
+    Remembers how runs turned out. A run is keyed by a hash of the CPU's
+    whole state before it starts (RAM, registers, PC and FL), the devices
+    on its bus, the engine and its settings, and the instruction budget.
+    Each entry keeps what the program printed, its final state, its
+    instruction count and how it ended, so running the same thing again
+    gives the same result without emulating a single instruction.
+
+    Only deterministic runs are saved: a run during which the timer or
+    keyboard raises an interrupt, serviced or not, or that uses a
+    nondeterministic device (see CPU.deterministic) still runs, but isn't
+    cached, and neither is one cut short by its time
+    budget. Entries live in one JSON file each, and once the directory
+    holds more than max_bytes or max_entries the least recently used ones
+    are thrown away.
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES,
+                 max_entries=CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        # runs answered from the cache, run and saved, and run but not
+        # cacheable
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def key(self, cpu, max_instructions=None):
+        """The cache key for running this CPU from its current state."""
+
+        digest = hashlib.sha256(CACHE_VERSION)
+
+        # engines agree on halted runs, but can stop at different places
+        # when a budget runs out, so each gets its own entries
+        settings = (type(cpu).__name__, cpu.fuse, cpu.trap_faults, max_instructions)
+        digest.update(repr(settings).encode())
+
+        # a store to a mapped address does something else entirely
+        digest.update(" ".join(
+            "" if device is None else type(device).__name__
+            for device in cpu.devices
+        ).encode())
+
+        digest.update(cpu.snapshot())
+
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def run(self, cpu, max_instructions=None, timeout=None):
+        """
+        Run the CPU as CPU.run() would, or put it straight into the state
+        and output a cached run left behind. Returns a RunResult, with
+        `cached` set if it came from the cache.
+        """
+
+        start = time.monotonic()
+        key = self.key(cpu, max_instructions)
+
+        entry = self.load(key)
+        if entry is not None:
+            self.hits += 1
+            return self.replay(cpu, entry, time.monotonic() - start)
+
+        # note everything printed on the way, still printing it as usual
+        output = cpu.output
+        output_write = output.write
+        printed = []
+
+        def write(text):
+            printed.append(text)
+            output_write(text)
+
+        output.write = write
+        cpu.deterministic = True
+
+        try:
+            result = cpu.run(max_instructions, timeout)
+        finally:
+            del output.write
+
+        # where the clock stopped the run depends on how fast it went
+        timed_out = result.status == BUDGET_EXHAUSTED and timeout is not None
+
+        if not cpu.deterministic or timed_out:
+            self.bypassed += 1
+            return result
+
+        self.misses += 1
+        entry = {
+            "status": result.status,
+            "instructions": result.instructions,
+            "output": "".join(printed),
+            "state": cpu.snapshot().hex(),
+        }
+        if result.fault is not None:
+            entry["fault"] = result.fault.to_dict()
+
+        self.save(key, entry)
+
+        return result
+
+    def replay(self, cpu, entry, elapsed):
+        # do to the CPU everything the cached run did
+        cpu.restore(bytes.fromhex(entry["state"]))
+        cpu.instruction_count += entry["instructions"]
+
+        fault = None
+        if "fault" in entry:
+            fault = CPUFault.from_dict(entry["fault"])
+            cpu.fault = fault
+
+        cpu.output.write(entry["output"])
+        cpu.output.flush()
+
+        result = RunResult(entry["status"], entry["instructions"], elapsed, fault)
+        result.cached = True
+        return result
+
+    def load(self, key):
+        try:
+            with open(self.path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # mark it as just used, for eviction
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+
+        return entry
+
+    def save(self, key, entry):
+        data = json.dumps(entry)
+
+        # an entry bigger than the whole cache is never kept
+        if len(data) > self.max_bytes:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # write then rename, so a reader never sees half an entry
+        temp = self.path(key) + f".{os.getpid()}.tmp"
+        with open(temp, "w") as f:
+            f.write(data)
+        os.replace(temp, self.path(key))
+
+        self.evict()
+
+    def evict(self):
+        """Throw away least recently used entries until the cache fits."""
+
+        entries = []
+        total = 0
+
+        with os.scandir(self.directory) as scan:
+            for item in scan:
+                if not item.name.endswith(".json"):
+                    continue
+                try:
+                    stat = item.stat()
+                except OSError:
+                    # another process evicted it first
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, item.path))
+                total += stat.st_size
+
+        entries.sort()
+        count = len(entries)
+
+        # oldest first, until both limits are met
+        for _, size, path in entries:
+            if total <= self.max_bytes and count <= self.max_entries:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            count -= 1
@@ -1,6 +1,10 @@
 """CPU functionality."""
 
+import asyncio
+import struct
 import sys
+import time
+from output import BufferedOutput
       # AABCDDDD
 LDI = 0b10000010 # load value into register
 PRN = 0b01000111 # print value
@@ -13,6 +17,10 @@ CMP = 0b10100111 # compare two registers
 JMP = 0b01010100 # jump to address
 JEQ = 0b01010101 # jump if equal
 JNE = 0b01010110 # jump if not equal
+JGT = 0b01010111 # jump if greater than
+JLT = 0b01011000 # jump if less than
+JLE = 0b01011001 # jump if less than or equal
+JGE = 0b01011010 # jump if greater than or equal
 CALL = 0b01010000 # call a subroutine
 RET = 0b00010001 # return from a subroutine
 AND = 0b10101000 # bitwise-AND
@@ -22,23 +30,372 @@ NOT = 0b01101001 # bitwise-NOT
 MOD = 0b10100100 # get the remainder
 SHL = 0b10101100 # shift left
 SHR = 0b10101101 # shift right
+PRA = 0b01001000 # print alpha character
+LD = 0b10000011 # load register from memory
+ST = 0b10000100 # store register in memory
+INT = 0b01010010 # issue an interrupt
+IRET = 0b00010011 # return from an interrupt handler
+SUB = 0b10100001 # subtraction
+DIV = 0b10100011 # integer division
+INC = 0b01100101 # increment
+DEC = 0b01100110 # decrement
+
+# opcode names, for reports and disassembly
+OPCODE_NAMES = {
+    LDI: "LDI", PRN: "PRN", HLT: "HLT", MUL: "MUL", ADD: "ADD",
+    PUSH: "PUSH", POP: "POP", CMP: "CMP", JMP: "JMP", JEQ: "JEQ",
+    JNE: "JNE", CALL: "CALL", RET: "RET", AND: "AND", OR: "OR",
+    XOR: "XOR", NOT: "NOT", MOD: "MOD", SHL: "SHL", SHR: "SHR",
+    SUB: "SUB", DIV: "DIV", INC: "INC", DEC: "DEC", PRA: "PRA",
+    LD: "LD", ST: "ST", INT: "INT", IRET: "IRET", JGT: "JGT",
+    JLT: "JLT", JLE: "JLE", JGE: "JGE",
+}
+
+# -- INTERRUPTS --
+IM = 5 # register holding the interrupt mask
+IS = 6 # register holding the interrupt status
+SP = 7 # register holding the stack pointer
+KEY_PRESSED = 0xf4 # address holding the most recent key pressed
+VECTOR_TABLE = 0xf8 # address of the I0 vector; I1-I7 follow it
+
+TIMER_INTERRUPT = 0b00000001 # I0, once a second
+KEYBOARD_INTERRUPT = 0b00000010 # I1, when a key is pressed
+
+# how many instructions run() runs between checks of the timer and keyboard.
+# Checking costs a clock read, so it's only done every so often
+INTERRUPT_CHECK_INTERVAL = 1024
+
+# the most instructions one step can run, as a fused sequence (see fuse_at)
+MAX_FUSED = 3
+
+# the device table of a CPU with nothing mapped (see CPU.map_device)
+NO_DEVICES = (None,) * 256
+
+# -- BINARY IMAGE FORMAT --
+# An .ls8b image is an 8-byte header, the full 256-byte memory image and an
+# optional symbol section:
+#
+#   header:  magic "LS8\0", version (1 byte), flags (1 byte),
+#            program length in bytes (2 bytes, little-endian)
+#   memory:  256 bytes, loaded at address 0
+#   symbols: (only if flags bit 0 is set) symbol count (2 bytes,
+#            little-endian), then for each symbol its address (1 byte),
+#            name length (1 byte) and ASCII name
+IMAGE_MAGIC = b"LS8\0"
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct("<4sBBH")
+IMAGE_HAS_SYMBOLS = 0b00000001
+
+# -- SNAPSHOTS --
+# A snapshot is a 10-byte header followed by the 264 bytes of memory
+# (RAM, then R0-R7, which include IM and IS):
+#
+#   header: magic "LS8S", version (1 byte), flags (1 byte: bit 0 running,
+#           bit 1 interrupts enabled), PC (2 bytes, little-endian),
+#           FL (1 byte), reserved (1 byte)
+SNAPSHOT_MAGIC = b"LS8S"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sBBHBx")
+SNAPSHOT_RUNNING = 0b00000001
+SNAPSHOT_INTERRUPTS_ENABLED = 0b00000010
+
+# -- ALU OPERATIONS --
+# each takes the values of register A and register B and returns the new
+# value of register A (or of FL, for CMP). Results are kept to 8 bits.
+
+def alu_add(a, b):
+    return (a + b) & 0xff
+
+def alu_sub(a, b):
+    return (a - b) & 0xff
+
+def alu_mul(a, b):
+    return (a * b) & 0xff
+
+def alu_div(a, b):
+    return a // b
+
+def alu_mod(a, b):
+    return a % b
+
+def alu_and(a, b):
+    return a & b
+
+def alu_or(a, b):
+    return a | b
+
+def alu_xor(a, b):
+    return a ^ b
+
+def alu_not(a, b):
+    return ~a & 0xff
+
+def alu_shl(a, b):
+    return (a << b) & 0xff
+
+def alu_shr(a, b):
+    return a >> b
+
+def alu_inc(a, b):
+    return (a + 1) & 0xff
+
+def alu_dec(a, b):
+    return (a - 1) & 0xff
+
+def alu_cmp(a, b):
+    # 00000LGE less,greater,equal
+    if a == b:
+        return 0b00000001
+    elif a > b:
+        return 0b00000010
+    else: # a is less
+        return 0b00000100
+
+# ALU operations indexed directly by opcode--one slot for every possible
+# byte, so dispatch is a single list index
+ALU_OPS = [None] * 256
+ALU_OPS[ADD] = alu_add
+ALU_OPS[SUB] = alu_sub
+ALU_OPS[MUL] = alu_mul
+ALU_OPS[DIV] = alu_div
+ALU_OPS[MOD] = alu_mod
+ALU_OPS[AND] = alu_and
+ALU_OPS[OR] = alu_or
+ALU_OPS[XOR] = alu_xor
+ALU_OPS[NOT] = alu_not
+ALU_OPS[SHL] = alu_shl
+ALU_OPS[SHR] = alu_shr
+ALU_OPS[INC] = alu_inc
+ALU_OPS[DEC] = alu_dec
+ALU_OPS[CMP] = alu_cmp
+
+# -- CONDITIONAL BRANCHES --
+# the FL bits each conditional jump tests, 00000LGE. JNE is taken
+# when E is clear, every other branch when any of its bits are set
+FL_EQUAL = 0b00000001
+FL_GREATER = 0b00000010
+FL_LESS = 0b00000100
+
+# whether each conditional jump is taken, worked out ahead of time for
+# every possible FL value, so a branch is a single index: taken[fl]
+def branch_table(test):
+    return tuple(bool(test(fl)) for fl in range(256))
+
+JEQ_TAKEN = branch_table(lambda fl: fl & FL_EQUAL)
+JNE_TAKEN = branch_table(lambda fl: not fl & FL_EQUAL)
+JGT_TAKEN = branch_table(lambda fl: fl & FL_GREATER)
+JLT_TAKEN = branch_table(lambda fl: fl & FL_LESS)
+JGE_TAKEN = branch_table(lambda fl: fl & (FL_GREATER | FL_EQUAL))
+JLE_TAKEN = branch_table(lambda fl: fl & (FL_LESS | FL_EQUAL))
+
+BRANCH_TAKEN = {
+    JEQ: JEQ_TAKEN,
+    JNE: JNE_TAKEN,
+    JGT: JGT_TAKEN,
+    JLT: JLT_TAKEN,
+    JGE: JGE_TAKEN,
+    JLE: JLE_TAKEN,
+}
+
+# -- FAULTS --
+# An instruction the CPU can't carry out raises a CPUFault. By default the
+# fault stops the CPU and run() returns it in its RunResult; with
+# trap_faults set, the program's own handler gets it instead (see
+# take_fault()). The fault codes are what that handler finds in R0
+FAULT_UNKNOWN_INSTRUCTION = 1 # the opcode isn't in the instruction set
+FAULT_DIVISION_BY_ZERO = 2 # DIV or MOD by 0
+FAULT_BAD_REGISTER = 3 # an operand names a register past R7
+FAULT_PC_OUT_OF_RANGE = 4 # the PC ran off the top of RAM
+
+FAULT_VECTOR = VECTOR_TABLE + 7 # faults are trapped through I7's vector
+
+class CPUFault(Exception):
+    """
+    An error in the running program, raised by the instruction at `pc`
+    (whose opcode, if there was one to fetch, is `opcode`).
+    """
+    
+    code = 0
+    
+    def __init__(self, pc, opcode, reason):
+        super().__init__(reason)
+        self.pc = pc
+        self.opcode = opcode
+        self.reason = reason
+        
+    @classmethod
+    def from_dict(cls, data):
+        """The fault that to_dict() returned `data` for."""
+        
+        fault_type = FAULT_TYPES[data["code"]]
+        fault = fault_type.__new__(fault_type)
+        CPUFault.__init__(fault, data["pc"], data["opcode"], data["reason"])
+        return fault
+        
+    def to_dict(self):
+        return {
+            "code": self.code,
+            "type": type(self).__name__,
+            "pc": self.pc,
+            "opcode": self.opcode,
+            "reason": self.reason,
+        }
+    
+class UnknownInstruction(CPUFault):
+    code = FAULT_UNKNOWN_INSTRUCTION
+    
+    def __init__(self, pc, opcode):
+        super().__init__(pc, opcode, f"Unknown instruction {opcode} at address {pc}")
+        
+class DivisionByZero(CPUFault):
+    code = FAULT_DIVISION_BY_ZERO
+    
+    def __init__(self, pc, opcode):
+        super().__init__(pc, opcode, "Error: division by 0 attempted")
+        
+class BadRegister(CPUFault):
+    code = FAULT_BAD_REGISTER
+    
+    def __init__(self, pc, opcode):
+        name = OPCODE_NAMES.get(opcode, opcode)
+        super().__init__(pc, opcode, f"Bad register operand for {name} at address {pc}")
+        
+class PCOutOfRange(CPUFault):
+    code = FAULT_PC_OUT_OF_RANGE
+    
+    def __init__(self, pc):
+        super().__init__(pc, None, f"PC ran off the end of memory at address {pc}")
+        
+# fault code -> CPUFault subclass
+FAULT_TYPES = {
+    fault_type.code: fault_type
+    for fault_type in (UnknownInstruction, DivisionByZero, BadRegister, PCOutOfRange)
+}
+
+def bad_registers(ir, operand_a, operand_b):
+    """Whether an instruction names a register that doesn't exist."""
+    
+    # every operand names a register, except LDI's value
+    operands = 1 if ir == LDI else ir >> 6
+    
+    return (operands >= 1 and operand_a > 7) or (operands >= 2 and operand_b > 7)
+
+# -- RUN RESULTS --
+# how a run() ended
+HALTED = "halted" # the program ran HLT
+BUDGET_EXHAUSTED = "budget-exhausted" # it ran out of instructions or time
+FAULTED = "faulted" # it hit an error it can't carry on from
+
+class RunResult:
+    """The outcome of CPU.run(): how it ended, and what it cost."""
+    
+    def __init__(self, status, instructions, elapsed, fault=None):
+        self.status = status
+        
+        # instructions run and seconds taken by this run
+        self.instructions = instructions
+        self.elapsed = elapsed
+        
+        # what went wrong, if the program faulted: the CPUFault, and
+        # its message
+        self.fault = fault
+        self.error = None if fault is None else str(fault)
+        
+        # whether the result came from a ResultCache rather than a run
+        self.cached = False
+        
+    def to_dict(self):
+        result = {
+            "status": self.status,
+            "instructions": self.instructions,
+            "elapsed": self.elapsed,
+        }
+        if self.fault is not None:
+            result["error"] = self.error
+            result["fault"] = self.fault.to_dict()
+        if self.cached:
+            result["cached"] = True
+        return result
+    
+    def __repr__(self):
+        return (f"RunResult({self.status!r}, {self.instructions}, "
+                f"{self.elapsed:.6f}, {self.error!r})")
+
 class CPU:
     """Main CPU class."""
 
-    def __init__(self):
-        """Construct a new CPU."""
-        
-        self.ram = [0] * 256
+    def __init__(self, output=None, keyboard=None):
+        """
+        Construct a new CPU. Everything it prints goes to the given output
+        device (see output.py), buffered stdout by default. Keys from the
+        keyboard (see devices.py), if there is one, raise interrupt I1.
+        """
         
-        # 8 registers
+        # RAM is a bytearray, 256 bytes rather than a list's 2KB, since the
+        # run loop mostly reads predecoded instructions rather than RAM. The
+        # 8 registers are read by nearly every instruction, so they stay a
+        # list, the cheapest thing to index. Everything that writes either
+        # keeps the value to 8 bits (a bytearray refuses anything else);
+        # snapshot() packs the registers into bytes
+        self.ram = bytearray(256)
         self.reg = [0] * 8
         
+        # predecoded instructions, one slot per RAM address. A slot is
+        # filled the first time the PC lands on it and cleared whenever
+        # ram_write() touches one of the instruction's bytes
+        self.decoded = [None] * 256
+        
+        # address -> the start of the earliest fused instruction (see
+        # fuse_at()) built from its byte. Only a few addresses ever are
+        self.fused_into = {}
+        
+        # whether decode() fuses common instruction sequences
+        self.fuse = True
+        
         # Program Counter
         self.pc = 0 
         
         # set the fl: 00000LGE less,greater,equal
         self.fl = 0b00000000
         
+        # where PRN and PRA send their output
+        self.output = output if output is not None else BufferedOutput()
+        
+        # the device mapped at each RAM address, or None for plain RAM.
+        # LD and ST go through these (see map_device). Until something is
+        # mapped every CPU shares the same table of Nones
+        self.devices = NO_DEVICES
+        
+        # interrupt sources. The keyboard also latches its keys at KEY_PRESSED
+        self.keyboard = None
+        if keyboard is not None:
+            self.attach_keyboard(keyboard)
+        
+        # when the next timer interrupt is due, set on the first check
+        self.timer_deadline = None
+        
+        # cleared while an interrupt handler runs
+        self.interrupts_enabled = True
+        
+        # label addresses, if the loaded program came with any
+        self.symbols = {}
+        
+        # how many instructions run() has executed
+        self.instruction_count = 0
+        
+        # the fault register: the most recent CPUFault, if there's been one
+        self.fault = None
+        
+        # whether faults trap to the handler at FAULT_VECTOR rather than
+        # stopping the CPU (see take_fault())
+        self.trap_faults = False
+        
+        # cleared once the program sees anything from the outside world--the
+        # timer or keyboard latching an interrupt, or a device that isn't
+        # deterministic--
+        # after which running it again could give a different result
+        self.deterministic = True
+        
         # set register 7 to point to the top of the stack
         self.reg[7] = 0xf4
         
@@ -57,6 +414,10 @@ class CPU:
         self.instruction_set[JMP] = self.JMP
         self.instruction_set[JEQ] = self.JEQ
         self.instruction_set[JNE] = self.JNE
+        self.instruction_set[JGT] = self.JGT
+        self.instruction_set[JLT] = self.JLT
+        self.instruction_set[JGE] = self.JGE
+        self.instruction_set[JLE] = self.JLE
         self.instruction_set[CALL] = self.CALL
         self.instruction_set[RET] = self.RET
         self.instruction_set[AND] = self.AND
@@ -66,85 +427,525 @@ class CPU:
         self.instruction_set[MOD] = self.MOD
         self.instruction_set[SHL] = self.SHL
         self.instruction_set[SHR] = self.SHR
+        self.instruction_set[SUB] = self.SUB
+        self.instruction_set[DIV] = self.DIV
+        self.instruction_set[INC] = self.INC
+        self.instruction_set[DEC] = self.DEC
+        self.instruction_set[PRA] = self.PRA
+        self.instruction_set[LD] = self.LD
+        self.instruction_set[ST] = self.ST
+        self.instruction_set[INT] = self.INT
+        self.instruction_set[IRET] = self.IRET
         self.running = False
         
     def ram_read(self, mar):
         return self.ram[mar]
     
+    def map_device(self, device, address, size=1):
+        """
+        Map a device (see devices.py) onto `size` addresses starting at the
+        given one. LD and ST on those addresses call the device's
+        read(address) and write(address, value) instead of using RAM. Using
+        a device whose `deterministic` attribute isn't true clears
+        self.deterministic.
+        """
+        
+        if address < 0 or size < 1 or address + size > 256:
+            raise ValueError(f"Can't map {size} byte(s) at address {address}")
+        
+        if self.devices is NO_DEVICES:
+            self.devices = [None] * 256
+            
+        for mapped in range(address, address + size):
+            self.devices[mapped] = device
+            
+    def attach_keyboard(self, keyboard):
+        """
+        Take keys from the given keyboard (see devices.py), raising
+        interrupt I1 and latching them at KEY_PRESSED.
+        """
+        
+        self.keyboard = keyboard
+        self.map_device(keyboard, KEY_PRESSED)
+        
+    def unmap_device(self, address, size=1):
+        """Put plain RAM back at the given addresses."""
+        
+        if self.devices is NO_DEVICES:
+            return
+        
+        for mapped in range(address, address + size):
+            self.devices[mapped] = None
+            
+    def bus_read(self, mar):
+        # RAM unless a device is mapped here
+        device = self.devices[mar]
+        if device is None:
+            return self.ram[mar]
+        if not getattr(device, "deterministic", False):
+            self.deterministic = False
+        return device.read(mar) & 0xff
+    
+    def bus_write(self, mar, mdr):
+        device = self.devices[mar]
+        if device is None:
+            self.ram_write(mar, mdr & 0xff)
+        else:
+            if not getattr(device, "deterministic", False):
+                self.deterministic = False
+            device.write(mar, mdr & 0xff)
+    
     def ram_write(self, mar, mdr):
+        # mdr is already a byte: it comes from a register, or is
+        # masked by the caller
         self.ram[mar] = mdr
+        
+        # throw away any predecoded instruction whose bytes cover this
+        # address. Instructions are at most 3 bytes long, so only the
+        # entries starting here and at the two addresses before can be
+        # stale (negative indexes wrap around to the top of RAM, which is
+        # exactly how operand fetches wrap in decode())
+        decoded = self.decoded
+        decoded[mar] = None
+        decoded[mar - 1] = None
+        decoded[mar - 2] = None
+        
+        # fused instructions are longer, so they're tracked separately
+        fused_start = self.fused_into.get(mar)
+        if fused_start is not None:
+            for address in range(fused_start, mar):
+                decoded[address] = None
+        
+    def ram_write_block(self, mar, data):
+        """Copy a run of bytes into RAM starting at the given address."""
+        
+        self.ram[mar:mar + len(data)] = data
+        
+        # throw away the predecoded instructions over the whole run, plus
+        # the two before it that could reach into it, plus any fused
+        # instructions that reach into it from further back
+        start = mar - 2
+        for address in range(mar, mar + len(data)):
+            fused_start = self.fused_into.get(address)
+            if fused_start is not None and fused_start < start:
+                start = fused_start
+                
+        decoded = self.decoded
+        for address in range(start, mar + len(data)):
+            decoded[address] = None
+            
+    def ram_dump(self, start=0, end=256):
+        """Return a range of RAM as bytes."""
+        
+        return bytes(self.ram[start:end])
+        
+    def clear_caches(self):
+        """Forget every predecoded instruction, e.g. after replacing RAM."""
+        
+        self.decoded = [None] * 256
+        self.fused_into = {}
+        
+    def snapshot(self):
+        """
+        Return the complete machine state--RAM, registers, PC, FL, IM/IS,
+        and whether it's running and taking interrupts--as a compact blob
+        that restore() loads back.
+        """
+        
+        flags = 0
+        if self.running:
+            flags |= SNAPSHOT_RUNNING
+        if self.interrupts_enabled:
+            flags |= SNAPSHOT_INTERRUPTS_ENABLED
+            
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags, self.pc, self.fl
+        )
+        
+        return header + bytes(self.ram) + bytes(self.reg)
+    
+    def restore(self, blob):
+        """Put the machine back in the state saved by snapshot()."""
+        
+        magic, version, flags, pc, fl = SNAPSHOT_HEADER.unpack_from(blob)
+        
+        if (magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION
+                or len(blob) != SNAPSHOT_HEADER.size + 256 + 8):
+            raise ValueError("Not an LS-8 snapshot, or an unsupported version")
+        
+        # copy RAM and registers back in place, so anything holding
+        # them (like fused instructions) sees the new values
+        memory = memoryview(blob)[SNAPSHOT_HEADER.size:]
+        self.ram[:] = memory[:256]
+        self.reg[:] = memory[256:]
+        
+        self.pc = pc
+        self.fl = fl
+        self.running = bool(flags & SNAPSHOT_RUNNING)
+        self.interrupts_enabled = bool(flags & SNAPSHOT_INTERRUPTS_ENABLED)
+        
+        # every instruction in RAM may have changed
+        self.clear_caches()
+        
+    @classmethod
+    def from_snapshot(cls, blob, output=None):
+        """Construct a new CPU in the state saved by snapshot()."""
+        
+        cpu = cls(output)
+        cpu.restore(blob)
+        return cpu
+    
+    def fork(self, output=None):
+        """
+        Return a new CPU in exactly this CPU's state, ready to carry on
+        from here independently. The child gets its own copy of memory
+        (264 values, cheaper to copy than to track) and its own output
+        device; it starts with no keyboard or other devices attached.
+        """
+        
+        child = type(self)(output)
+        
+        child.ram[:] = self.ram
+        child.reg[:] = self.reg
+        
+        child.pc = self.pc
+        child.fl = self.fl
+        child.running = self.running
+        child.interrupts_enabled = self.interrupts_enabled
+        child.timer_deadline = self.timer_deadline
+        child.symbols = self.symbols
+        child.instruction_count = self.instruction_count
+        child.fault = self.fault
+        child.trap_faults = self.trap_faults
+        child.deterministic = self.deterministic
+        
+        return child
+    
+    def decode(self, address):
+        """
+        Decode the instruction at the given address into a cached record of
+        (handler, operand_a, operand_b, instruction_length). Returns None if
+        the opcode is not in the instruction set, and raises BadRegister if
+        an operand names a register that doesn't exist.
+        """
+        
+        ir = self.ram[address]
+        
+        handler = self.instruction_set.get(ir)
+        if handler is None:
+            return None
+        
+        # the number of operands lives in the top two bits, so
+        # the whole instruction is that many bytes plus the opcode
+        instruction_length = ((ir & 0b11000000) >> 6) + 1
+        
+        # fetch both operand bytes up front, whether the instruction
+        # uses them or not--this keeps every record the same shape
+        entry = (
+            handler,
+            self.ram[(address + 1) & 0xff],
+            self.ram[(address + 2) & 0xff],
+            instruction_length
+        )
+        
+        # checking registers once here means the handlers never have to
+        if bad_registers(ir, entry[1], entry[2]):
+            raise BadRegister(address, ir)
+        
+        # common runs of instructions starting here get replaced with
+        # one fused operation
+        if self.fuse:
+            fused = self.fuse_at(address, ir, entry)
+            if fused is not None:
+                entry = fused
+                
+        self.decoded[address] = entry
+        
+        return entry
+        
+    # -- SUPERINSTRUCTIONS --
+    # Common sequences of instructions are decoded into one fused operation
+    # that has exactly the same effect on registers, flags, memory and the
+    # PC as running them one by one, but costs one trip round the run loop.
+    # Fusion only ever looks forward from the instruction being decoded, so
+    # jumping into the middle of a sequence still runs the plain instruction.
+    
+    def fuse_at(self, address, ir, entry):
+        """
+        Return a fused record for the sequence starting at the given address
+        (whose first instruction decoded to entry), or None if it doesn't
+        start a sequence we fuse.
+        """
+        
+        _, operand_a, operand_b, instruction_length = entry
+        
+        next_address = address + instruction_length
+        
+        # don't fuse anything that would wrap past the top of RAM
+        if next_address + 3 > 256:
+            return None
+        
+        ram = self.ram
+        next_ir = ram[next_address]
+        next_a = ram[next_address + 1]
+        next_b = ram[next_address + 2]
+        
+        # an instruction with a bad register has to fault on its own
+        if bad_registers(next_ir, next_a, next_b):
+            return None
+        
+        fused = None
+        
+        if ir == LDI and next_ir == JMP and next_a == operand_a:
+            # LDI Rx,addr; JMP Rx
+            fused = self.fuse_ldi_jmp(operand_a, operand_b)
+            length = instruction_length + 2
+            
+        elif ir == CMP and next_ir in BRANCH_TAKEN:
+            # CMP Ra,Rb; JEQ/JNE/JGT/JLT/JGE/JLE Rx
+            fused = self.fuse_cmp_branch(
+                operand_a, operand_b, next_a, BRANCH_TAKEN[next_ir], next_address + 2
+            )
+            length = instruction_length + 2
+            
+        elif ir == PUSH and next_ir == CALL:
+            # PUSH Rx; CALL Ry
+            fused = self.fuse_push_call(address, operand_a, next_a, next_address + 2)
+            length = instruction_length + 2
+            
+        elif ir == LDI and next_ir == LDI:
+            third_address = next_address + 3
+            
+            if (third_address + 3 <= 256 and ram[third_address] == MUL
+                    and not bad_registers(MUL, ram[third_address + 1], ram[third_address + 2])):
+                # LDI Rx,i; LDI Ry,j; MUL Ra,Rb
+                fused = self.fuse_ldi_ldi_mul(
+                    operand_a, operand_b, next_a, next_b,
+                    ram[third_address + 1], ram[third_address + 2]
+                )
+                length = instruction_length + 6
+            else:
+                # LDI Rx,i; LDI Ry,j
+                fused = self.fuse_ldi_ldi(operand_a, operand_b, next_a, next_b)
+                length = instruction_length + 3
+                
+        if fused is None:
+            return None
+        
+        # remember which bytes this fused record was built from, so a
+        # write to any of them throws it away
+        fused_into = self.fused_into
+        for covered in range(address, address + length):
+            if fused_into.get(covered, address) >= address:
+                fused_into[covered] = address
+                
+        # the run loop passes the operands in, but fused operations
+        # already hold everything they need
+        return (fused, None, None, length)
+    
+    def fuse_ldi_jmp(self, reg_num, value):
+        reg = self.reg
+        
+        def ldi_jmp(_a, _b):
+            reg[reg_num] = value
+            self.pc = value
+            # one run loop trip, two instructions
+            self.instruction_count += 1
+            return True
+        
+        return ldi_jmp
+    
+    def fuse_cmp_branch(self, reg_a, reg_b, reg_target, taken, next_pc):
+        reg = self.reg
+        
+        def cmp_branch(_a, _b):
+            self.fl = fl = alu_cmp(reg[reg_a], reg[reg_b])
+            self.instruction_count += 1
+            
+            # look up whether the branch is taken for these flags
+            if taken[fl]:
+                self.pc = reg[reg_target]
+            else:
+                self.pc = next_pc
+            return True
+        
+        return cmp_branch
+    
+    def fuse_push_call(self, address, reg_num, reg_target, return_addr):
+        SP = 7
+        reg = self.reg
+        decoded = self.decoded
+        
+        def push_call(_a, _b):
+            # PUSH: decrement SP first, then store the register
+            reg[SP] = (reg[SP] - 1) & 0xff
+            self.ram_write(reg[SP], reg[reg_num])
+            
+            # if the push just overwrote this code, stop here and let
+            # the CALL be decoded again from its new bytes
+            if decoded[address] is None:
+                self.pc = address + 2
+                return True
+            
+            # CALL: push the return address, then read the target
+            self.push_value(return_addr)
+            self.pc = reg[reg_target]
+            self.instruction_count += 1
+            return True
+        
+        return push_call
+    
+    def fuse_ldi_ldi(self, reg_x, value_x, reg_y, value_y):
+        reg = self.reg
+        
+        def ldi_ldi(_a, _b):
+            reg[reg_x] = value_x
+            reg[reg_y] = value_y
+            self.instruction_count += 1
+        
+        return ldi_ldi
+    
+    def fuse_ldi_ldi_mul(self, reg_x, value_x, reg_y, value_y, reg_a, reg_b):
+        reg = self.reg
+        
+        def ldi_ldi_mul(_a, _b):
+            reg[reg_x] = value_x
+            reg[reg_y] = value_y
+            reg[reg_a] = alu_mul(reg[reg_a], reg[reg_b])
+            self.instruction_count += 2
+        
+        return ldi_ldi_mul
 
-    def load(self):
+    def load(self, filename=None):
         """Load a program into memory."""
         
         # -- LOAD PROGRAM --
         
-        # handle no argument for program
-        if len(sys.argv) < 2:
-            print('You must enter a program to run')
-            sys.exit(1)
+        # default to the program named on the command line
+        if filename is None:
+            # handle no argument for program
+            if len(sys.argv) < 2:
+                raise ValueError('You must enter a program to run')
+                
+            filename = sys.argv[1]
+        
+        # read the whole file in one go
+        with open(filename, 'rb') as f:
+            data = f.read()
             
-        filename = sys.argv[1]
+        # binary images go straight into RAM
+        if data[:len(IMAGE_MAGIC)] == IMAGE_MAGIC:
+            self.load_image(data)
+            return
         
-        address = 0
+        program = bytearray()
         
-        with open(filename) as f:
-            for line in f:
-                line = line.split('#')
-                try:
-                    v = int(line[0], 2)
-                except ValueError:
-                    continue
+        for line in data.decode().splitlines():
+            line = line.split('#')
+            try:
+                v = int(line[0], 2)
+            except ValueError:
+                continue
+            
+            program.append(v)
+            
+        self.load_program(program)
+        
+    def load_program(self, program, symbols=None):
+        """
+        Load machine code (bytes, a bytearray or a list of byte values)
+        straight into memory at address 0, such as the output of the
+        assembler's asm.assemble(). Symbols, if given, end up in
+        self.symbols.
+        """
+        
+        # at most 256 bytes, so this copy is cheap, and it checks that
+        # every value fits in a byte
+        program = bytes(program)
+        
+        if len(program) > 256:
+            raise ValueError(f"Program too large: {len(program)} bytes")
+        
+        # copy the whole program into RAM in one go
+        self.ram_write_block(0, program)
+        
+        self.symbols = dict(symbols) if symbols is not None else {}
+        
+    def load_image(self, data):
+        """
+        Load a binary .ls8b image (see IMAGE_MAGIC above) into memory.
+        Symbols from the image, if any, end up in self.symbols.
+        """
+        
+        truncated = ValueError('Truncated LS-8 image')
+        
+        if len(data) < IMAGE_HEADER.size:
+            raise truncated
+        
+        magic, version, flags, length = IMAGE_HEADER.unpack_from(data)
+        
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+            raise ValueError('Not an LS-8 image, or an unsupported version')
+            
+        image_start = IMAGE_HEADER.size
+        image_end = image_start + 256
+        
+        if len(data) < image_end:
+            raise truncated
+        
+        # read the symbols before touching memory, so a bad image
+        # leaves the CPU as it was
+        symbols = {}
+        
+        if flags & IMAGE_HAS_SYMBOLS:
+            offset = image_end
+            
+            # symbol count, then (address, name length, name) per symbol
+            if len(data) < offset + 2:
+                raise truncated
+            count = int.from_bytes(data[offset:offset + 2], 'little')
+            offset += 2
+            
+            for _ in range(count):
+                if len(data) < offset + 2:
+                    raise truncated
+                address = data[offset]
+                name_length = data[offset + 1]
+                offset += 2
+                
+                if len(data) < offset + name_length:
+                    raise truncated
+                name = data[offset:offset + name_length].decode('ascii')
+                offset += name_length
+                
+                symbols[name] = address
                 
-                self.ram_write(address, v)
-                address += 1
+        # the memory image follows the header--copy it without slicing
+        # a new bytes object out of the file data
+        self.ram_write_block(0, memoryview(data)[image_start:image_end])
+        
+        self.symbols = symbols
 
 
     def alu(self, op, reg_a, reg_b):
-        """ALU operations."""
-
-        if op == "ADD":
-            self.reg[reg_a] += self.reg[reg_b]
-        elif op == "SUB":
-            self.reg[reg_a] -= self.reg[reg_b]
-        elif op == "MUL":
-            self.reg[reg_a] *= self.reg[reg_b]
-        elif op == "DIV":
-            self.reg[reg_a] /= self.reg[reg_b]
-        elif op == "AND":
-            self.reg[reg_a] = self.reg[reg_a] & self.reg[reg_b]
-        elif op == "OR":
-            self.reg[reg_a] = self.reg[reg_a] | self.reg[reg_b]
-        elif op == "XOR":
-            self.reg[reg_a] = self.reg[reg_a] ^ self.reg[reg_b]
-        elif op == "NOT":
-            self.reg[reg_a] = ~self.reg[reg_a]
-        elif op == "MOD":
-            if self.reg[reg_b] == 0:
-                # display error and halt--vision by 0 attempted
-                print("Error: division by 0 attempted")
-                sys.exit(1)
-            # else, we're good
-            self.reg[reg_a] = self.reg[reg_a] % self.reg[reg_b]
-        elif op == "SHL":
-            self.reg[reg_a] = self.reg[reg_a] << self.reg[reg_b]
-        elif op == "SHR":
-            self.reg[reg_a] = self.reg[reg_a] >> self.reg[reg_b]
-        elif op == "CMP":
-            # 00000LGE less,greater,equal
-            # get the values
-            val_a = self.reg[reg_a]
-            val_b = self.reg[reg_b]
-            # set what the flags should be
-            if val_a == val_b:
-                self.fl =  0b00000001
-            elif val_a > val_b:
-                self.fl = 0b00000010
-            else: # val_a is less
-                self.fl = 0b00000100
-        else:
+        """ALU operations, dispatched on the opcode byte."""
+
+        operation = ALU_OPS[op]
+        if operation is None:
             raise Exception("Unsupported ALU operation")
 
+        try:
+            result = operation(self.reg[reg_a], self.reg[reg_b])
+        except ZeroDivisionError:
+            # division by 0 attempted--the PC is still on this instruction
+            raise DivisionByZero(self.pc, op)
+
+        # CMP only sets the flags, everything else writes register A
+        if op == CMP:
+            self.fl = result
+        else:
+            self.reg[reg_a] = result
+
     def trace(self):
         """
         Handy function to print out the CPU state. You might want to call this
@@ -164,45 +965,35 @@ class CPU:
 
         print()
         
-    def LDI(self):
-        # get the register slot we want to write the value to
-        reg_num = self.ram_read(self.pc+1)
-        # get the value that we want to write to the register
-        value = self.ram_read(self.pc+2) 
+    def LDI(self, reg_num, value):
         # set the register at the desired slot to the desired value
         self.reg[reg_num] = value
         
-    def PRN(self):
-        # get the register slot we want to print the value of
-        reg_num = self.ram_read(self.pc+1)
+    def PRN(self, reg_num, _):
         # get that value by its slot
         value = self.reg[reg_num]
         # print!
-        print(value)
+        self.output.write(f"{value}\n")
         
-    def MUL(self):
-        # get the register slot of the first number
-        reg_num1 = self.ram_read(self.pc+1)
-        # get the register slot of the second number
-        reg_num2 = self.ram_read(self.pc+2)
+    def PRA(self, reg_num, _):
+        # get the character code by its slot
+        value = self.reg[reg_num]
+        # print it as a character, with no newline
+        self.output.write(chr(value))
+        
+    def MUL(self, reg_num1, reg_num2):
         # pass them off to the ALU
-        self.alu("MUL", reg_num1, reg_num2)
+        self.alu(MUL, reg_num1, reg_num2)
         
-    def ADD(self):
-        # get the register slot of the first number
-        reg_num1 = self.ram_read(self.pc+1)
-        # get the register slot of the second number
-        reg_num2 = self.ram_read(self.pc+2)
+    def ADD(self, reg_num1, reg_num2):
         # pass them off to the ALU
-        self.alu("ADD", reg_num1, reg_num2)
+        self.alu(ADD, reg_num1, reg_num2)
         
-    def PUSH(self):
+    def PUSH(self, reg_num, _):
         SP = 7
         # decrement SP--remember that it stacks going towards the bottom
-        self.reg[SP] -=1
+        self.reg[SP] = (self.reg[SP] - 1) & 0xff
         
-        # get the value we want to store
-        reg_num = self.ram_read(self.pc+1)
         # get the value
         value = self.reg[reg_num]
         
@@ -212,31 +1003,23 @@ class CPU:
         # store it
         self.ram_write(top_of_stack_addr, value)
         
-    def POP(self):
+    def POP(self, reg_num, _):
         SP = 7
         # get the address that the SP is pointing to
         address = self.reg[SP]
         # get the value of that address from RAM
         value = self.ram_read(address)
-        # get the number for the given register
-        reg_num = self.ram_read(self.pc+1)
         # write the value to this register
         self.reg[reg_num] = value
         # increment the SP--remember that it stacks going towards the bottom
-        self.reg[SP] +=1
-        
-    def CMP(self):
-        # get the first reg address
-        reg_a = self.ram_read(self.pc+1)
-        # get the second reg address
-        reg_b = self.ram_read(self.pc+2)
+        self.reg[SP] = (self.reg[SP] + 1) & 0xff
         
+    def CMP(self, reg_a, reg_b):
         # pass to the ALU
-        self.alu("CMP", reg_a, reg_b)
+        self.alu(CMP, reg_a, reg_b)
         
-    def JMP(self):
+    def JMP(self, reg_num, _):
         # get the register value to jump to
-        reg_num = self.ram_read(self.pc+1)
         address_to_jump_to = self.reg[reg_num]
         # jump the PC to this address
         self.pc = address_to_jump_to
@@ -245,31 +1028,54 @@ class CPU:
         # Useful for conditional jumps
         return True
         
-    def JEQ(self):
-        if self.fl == 0b00000001:
+    def JEQ(self, reg_num, _):
+        if JEQ_TAKEN[self.fl]:
             # the equal flag is set to 1 (true)
-            self.JMP()
+            self.pc = self.reg[reg_num]
             return True
             
-    def JNE(self):
-        if self.fl != 0b00000001:
+    def JNE(self, reg_num, _):
+        if JNE_TAKEN[self.fl]:
             # the equal flag is set to 0 (false)
-            self.JMP()
+            self.pc = self.reg[reg_num]
+            return True
+            
+    def JGT(self, reg_num, _):
+        if JGT_TAKEN[self.fl]:
+            # the greater-than flag is set
+            self.pc = self.reg[reg_num]
+            return True
+            
+    def JLT(self, reg_num, _):
+        if JLT_TAKEN[self.fl]:
+            # the less-than flag is set
+            self.pc = self.reg[reg_num]
+            return True
+            
+    def JGE(self, reg_num, _):
+        if JGE_TAKEN[self.fl]:
+            # the greater-than or equal flag is set
+            self.pc = self.reg[reg_num]
+            return True
+            
+    def JLE(self, reg_num, _):
+        if JLE_TAKEN[self.fl]:
+            # the less-than or equal flag is set
+            self.pc = self.reg[reg_num]
             return True
         
-    def CALL(self):
+    def CALL(self, reg_num, _):
         # get the return address
-        return_addr = self.pc+2 # this command has one parameter, so increment by 2
+        return_addr = (self.pc+2) & 0xff # this command has one parameter, so increment by 2
         
         # push the return address onto the stack
         SP = 7
         # decrement SP--remember that it stacks going towards the bottom
-        self.reg[SP] -=1
+        self.reg[SP] = (self.reg[SP] - 1) & 0xff
         # write to the stack with the return address
         self.ram_write(self.reg[SP], return_addr)
         
         # now, get the address that we want to call (move pc to)
-        reg_num = self.ram_read(self.pc+1)
         subroutine_addr = self.reg[reg_num]
         
         # call the subroutine
@@ -278,7 +1084,7 @@ class CPU:
         # This has to return true because we are moving--not ideal, but necessary for now
         return True
         
-    def RET(self):
+    def RET(self, *_):
         SP = 7
         # get the address that the SP is pointing to
         address = self.reg[SP]
@@ -289,97 +1095,384 @@ class CPU:
         # set the PC to the return address
         self.pc = return_addr
         # increment the SP--remember that it stacks going towards the bottom
-        self.reg[SP] +=1
+        self.reg[SP] = (self.reg[SP] + 1) & 0xff
         
         return True
     
-    def AND(self):
-        # get the register slot of the first number
-        reg_num1 = self.ram_read(self.pc+1)
-        # get the register slot of the second number
-        reg_num2 = self.ram_read(self.pc+2)
+    def AND(self, reg_num1, reg_num2):
         # pass them off to the ALU
-        self.alu("AND", reg_num1, reg_num2)
+        self.alu(AND, reg_num1, reg_num2)
         
-    def OR(self):
-        # get the register slot of the first number
-        reg_num1 = self.ram_read(self.pc+1)
-        # get the register slot of the second number
-        reg_num2 = self.ram_read(self.pc+2)
+    def OR(self, reg_num1, reg_num2):
         # pass them off to the ALU
-        self.alu("OR", reg_num1, reg_num2)
+        self.alu(OR, reg_num1, reg_num2)
         
-    def XOR(self):
-        # get the register slot of the first number
-        reg_num1 = self.ram_read(self.pc+1)
-        # get the register slot of the second number
-        reg_num2 = self.ram_read(self.pc+2)
+    def XOR(self, reg_num1, reg_num2):
         # pass them off to the ALU
-        self.alu("XOR", reg_num1, reg_num2)
+        self.alu(XOR, reg_num1, reg_num2)
         
-    def NOT(self):
-        # get the register slot of the number
-        reg_num = self.ram_read(self.pc+1)
+    def NOT(self, reg_num, _):
         # pass it off to the ALU--only one argument
-        self.alu("NOT", reg_num, None)
+        self.alu(NOT, reg_num, reg_num)
         
-    def MOD(self):
-        # get the register slot of the first number
-        reg_num1 = self.ram_read(self.pc+1)
-        # get the register slot of the second number
-        reg_num2 = self.ram_read(self.pc+2)
+    def MOD(self, reg_num1, reg_num2):
         # pass them off to the ALU
-        self.alu("MOD", reg_num1, reg_num2)
+        self.alu(MOD, reg_num1, reg_num2)
         
-    def SHL(self):
-        # get the register slot of the first number
-        reg_num1 = self.ram_read(self.pc+1)
-        # get the register slot of the second number
-        reg_num2 = self.ram_read(self.pc+2)
+    def SHL(self, reg_num1, reg_num2):
         # pass them off to the ALU
-        self.alu("SHL", reg_num1, reg_num2)
+        self.alu(SHL, reg_num1, reg_num2)
     
-    def SHR(self):
-        # get the register slot of the first number
-        reg_num1 = self.ram_read(self.pc+1)
-        # get the register slot of the second number
-        reg_num2 = self.ram_read(self.pc+2)
+    def SHR(self, reg_num1, reg_num2):
+        # pass them off to the ALU
+        self.alu(SHR, reg_num1, reg_num2)
+        
+    def SUB(self, reg_num1, reg_num2):
+        # pass them off to the ALU
+        self.alu(SUB, reg_num1, reg_num2)
+        
+    def DIV(self, reg_num1, reg_num2):
         # pass them off to the ALU
-        self.alu("SHR", reg_num1, reg_num2)
+        self.alu(DIV, reg_num1, reg_num2)
+        
+    def INC(self, reg_num, _):
+        # pass it off to the ALU--only one argument
+        self.alu(INC, reg_num, reg_num)
+        
+    def DEC(self, reg_num, _):
+        # pass it off to the ALU--only one argument
+        self.alu(DEC, reg_num, reg_num)
+        
+    def LD(self, reg_a, reg_b):
+        # load register A with the value at the address in register B
+        address = self.reg[reg_b]
+        device = self.devices[address]
+        
+        # plain RAM is read directly; only mapped addresses
+        # go out to their device
+        if device is None:
+            self.reg[reg_a] = self.ram[address]
+        else:
+            self.reg[reg_a] = self.bus_read(address)
+        
+    def ST(self, reg_a, reg_b):
+        # store register B's value at the address in register A
+        address = self.reg[reg_a]
+        device = self.devices[address]
+        
+        if device is None:
+            self.ram_write(address, self.reg[reg_b])
+        else:
+            self.bus_write(address, self.reg[reg_b])
+        
+    def INT(self, reg_num, _):
+        # set the interrupt's bit in IS
+        self.reg[IS] |= (1 << self.reg[reg_num]) & 0xff
+        
+        # interrupts are taken before the next instruction, so move
+        # past this one and take it right away if it's unmasked
+        self.pc += 2
+        self.service_interrupts()
+        
+        return True
+        
+    def IRET(self, *_):
+        # registers R6-R0 come back off the stack in reverse order
+        for reg_num in range(6, -1, -1):
+            self.reg[reg_num] = self.pop_value()
+            
+        # then FL, then the PC we were interrupted at
+        self.fl = self.pop_value()
+        self.pc = self.pop_value()
+        
+        # and interrupts are back on
+        self.interrupts_enabled = True
+        
+        return True
+        
+    def push_value(self, value):
+        # decrement SP and store the value at the new top of the stack
+        self.reg[SP] = (self.reg[SP] - 1) & 0xff
+        self.ram_write(self.reg[SP], value & 0xff)
+        
+    def pop_value(self):
+        # read the top of the stack and increment SP past it
+        value = self.ram_read(self.reg[SP])
+        self.reg[SP] = (self.reg[SP] + 1) & 0xff
+        return value
+        
+    def poll_interrupts(self):
+        """
+        Check the timer and keyboard, raising their interrupts as needed,
+        then service any unmasked interrupt. The run loops call this every
+        INTERRUPT_CHECK_INTERVAL instructions rather than before every
+        instruction, so the clock read is spread over many instructions.
+        """
+        
+        # timer: I0 once a second
+        now = time.monotonic()
+        if self.timer_deadline is None:
+            self.timer_deadline = now + 1
+        elif now >= self.timer_deadline:
+            self.reg[IS] |= TIMER_INTERRUPT
+            self.deterministic = False
+            # skip ahead rather than firing a backlog of missed seconds
+            self.timer_deadline = max(self.timer_deadline + 1, now)
+            
+        # keyboard: I1 with the key latched at KEY_PRESSED. Keys wait in
+        # the keyboard until the last one has been handled
+        if self.keyboard is not None and not self.reg[IS] & KEYBOARD_INTERRUPT:
+            if self.keyboard.read_key() is not None:
+                self.reg[IS] |= KEYBOARD_INTERRUPT
+                self.deterministic = False
+                
+        # a latched bit shows up in IS (and the final state) whether or
+        # not it's ever serviced. And a program listening for the timer or
+        # keyboard depends on when they fire, or whether they fire at all
+        # before it's done
+        listening = TIMER_INTERRUPT
+        if self.keyboard is not None:
+            listening |= KEYBOARD_INTERRUPT
+        if self.reg[IM] & listening:
+            self.deterministic = False
+            
+        self.service_interrupts()
+        
+        # this is also a good moment to let buffered output out, so
+        # long-running programs show their output as they go
+        self.output.flush()
+        
+    def service_interrupts(self):
+        """
+        If interrupts are enabled and one is both raised and unmasked, jump to
+        its handler, saving the machine state on the stack.
+        """
+        
+        if not self.interrupts_enabled:
+            return
+        
+        masked_interrupts = self.reg[IM] & self.reg[IS]
+        if not masked_interrupts:
+            return
+        
+        # the lowest numbered interrupt wins
+        for i in range(8):
+            if masked_interrupts & (1 << i):
+                break
+            
+        # no further interrupts until IRET
+        self.interrupts_enabled = False
+        
+        # clear its bit in IS
+        self.reg[IS] &= ~(1 << i) & 0xff
+        
+        self.enter_handler(VECTOR_TABLE + i)
+        
+    def enter_handler(self, vector):
+        # save the PC, FL and R0-R6 on the stack
+        self.push_value(self.pc)
+        self.push_value(self.fl)
+        for reg_num in range(7):
+            self.push_value(self.reg[reg_num])
+            
+        # and jump to the handler from the vector table
+        self.pc = self.ram_read(vector)
+        
+    def take_fault(self, fault):
+        """
+        Deal with a CPUFault raised by the instruction at fault.pc, noting it
+        in the fault register (self.fault).
+        
+        Normally the CPU stops and the fault is raised again for run() to
+        return. With trap_faults set it's taken like an interrupt instead:
+        the state is saved on the stack with the faulting instruction's
+        address as the PC, R0 and R1 are set to the fault code and opcode,
+        and the CPU jumps to the handler at FAULT_VECTOR. IRET runs the
+        faulting instruction again, so the handler should fix the cause,
+        move the saved PC on or HLT. A fault with interrupts disabled (in
+        any handler) can't be trapped, and stops the CPU.
+        """
+        
+        self.fault = fault
+        
+        if not self.trap_faults or not self.interrupts_enabled:
+            self.running = False
+            self.output.flush()
+            raise fault
+        
+        self.interrupts_enabled = False
         
-    def HLT(self):
+        self.pc = fault.pc & 0xff
+        self.enter_handler(FAULT_VECTOR)
+        
+        self.reg[0] = fault.code
+        self.reg[1] = fault.opcode if fault.opcode is not None else 0
+        
+    def HLT(self, *_):
         self.running = False
+        # get everything printed out now that we're done
+        self.output.flush()
 
-    def run(self):
-        """Run the CPU."""
+    def run(self, max_instructions=None, timeout=None):
+        """
+        Run the CPU until it halts, faults, or uses up its budget: at most
+        max_instructions instructions and timeout seconds, if given.
+        Returns a RunResult.
+        
+        Budgets are checked between slices of INTERRUPT_CHECK_INTERVAL
+        instructions, so they cost nothing per instruction. A run can go at
+        most a fused sequence (or, compiled, a block) over its instruction
+        budget, the same way every time. The time budget is good to within
+        a slice.
+        """
+        
+        budget = self.start_budget(max_instructions, timeout)
+        
+        try:
+            # run in slices, checking for interrupts between them
+            while self.running:
+                count = self.next_slice(INTERRUPT_CHECK_INTERVAL, budget)
+                if not count:
+                    return self.end_run(budget, BUDGET_EXHAUSTED)
+                self.run_slice(count)
+        except CPUFault as fault:
+            return self.end_run(budget, FAULTED, fault)
+            
+        return self.end_run(budget, HALTED)
+            
+    async def run_async(self, slice=INTERRUPT_CHECK_INTERVAL,
+                        max_instructions=None, timeout=None):
+        """
+        Run the CPU on an asyncio event loop, handing control back to the
+        loop after every `slice` instructions so many machines (and
+        anything else) can share it. Takes the same budgets as run(), and
+        returns a RunResult.
+        """
+        
+        budget = self.start_budget(max_instructions, timeout)
         
-        self.running = True
         while self.running:
-            ir = self.ram_read(self.pc)
+            count = self.next_slice(slice, budget)
+            if not count:
+                return self.end_run(budget, BUDGET_EXHAUSTED)
+            
+            try:
+                self.run_slice(count)
+            except CPUFault as fault:
+                return self.end_run(budget, FAULTED, fault)
+            
+            # let everything else on the loop have a turn
+            await asyncio.sleep(0)
+            
+        return self.end_run(budget, HALTED)
+    
+    def start_budget(self, max_instructions, timeout):
+        # start running, noting where the run started and the instruction
+        # count and clock time it has to stop at
+        self.running = True
+        
+        start_count = self.instruction_count
+        start_time = time.monotonic()
+        
+        limit = None if max_instructions is None else start_count + max_instructions
+        deadline = None if timeout is None else start_time + timeout
+        
+        return (start_count, start_time, limit, deadline)
+    
+    def next_slice(self, slice, budget):
+        # how many instructions the next slice may run--0 once the
+        # budget is used up
+        _, _, limit, deadline = budget
+        
+        if deadline is not None and time.monotonic() >= deadline:
+            return 0
+        
+        if limit is not None:
+            remaining = limit - self.instruction_count
+            if remaining <= 0:
+                return 0
             
-            # if the instruction exists in the instruction set,
-            if ir in self.instruction_set:
+            # a step can be a whole fused sequence, so near the end of the
+            # budget take slices small enough not to run past it
+            if remaining < slice * MAX_FUSED:
+                slice = max(1, remaining // MAX_FUSED)
                 
-                # do the instruction
-                # if jumping is true, it means this is a comparison
-                # op (JEQ, JGE, JGT, etc.) and it WILL be jumping
-                jumping = self.instruction_set[ir]()
+        return slice
+    
+    def end_run(self, budget, status, fault=None):
+        start_count, start_time, _, _ = budget
+        
+        return RunResult(status, self.instruction_count - start_count,
+                         time.monotonic() - start_time, fault)
+            
+    def run_slice(self, count):
+        """
+        Check for interrupts, then run at most `count` steps, stopping early
+        if the program halts. A step is one instruction, or one fused
+        sequence (see fuse_at()). Returns the number of steps run, and raises
+        CPUFault if the program faults and the fault isn't trapped.
+        """
+        
+        self.poll_interrupts()
+        
+        # local reference to the decode cache so the loop
+        # doesn't look it up on self every instruction
+        decoded = self.decoded
+        
+        # count instructions in a local and total them up on the way out,
+        # even if the program stops the interpreter. A step that faults to
+        # the handler hasn't run, as in the JIT and the profiler
+        executed = 0
+        trapped = 0
+        
+        try:
+            for executed in range(count):
+                if not self.running:
+                    break
                 
-                # whether the instruction increments the PC itself or not
-                sets_pc = (ir & 0b00010000) >> 4
-                # increment the pc using bitwise and shifting
-                instruction_length = (ir & 0b11000000) >> 6
+                pc = self.pc
                 
-                # if the instruction does not increment the PC itself,
-                # manually increment it. Additionally, if we are in an
-                # instruction that increments conditionally, 'jumping'
-                # will determine if it jumps
-                if (sets_pc == 0) or (sets_pc == 1 and not jumping):
-                    # pc should be incremented by this much
-                    pc_move_to = instruction_length + 1
-                    # increment pc
-                    self.pc += pc_move_to
+                # faults cost nothing until one is raised
+                try:
+                    # fetch the predecoded instruction, decoding it
+                    # the first time we land on this address
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = self.decode(pc)
+                        
+                        # if the instruction doesn't exist in the instruction set
+                        if entry is None:
+                            raise UnknownInstruction(pc, self.ram[pc])
+                            
+                    handler, operand_a, operand_b, instruction_length = entry
                     
+                    # do the instruction
+                    # if jumping is true, it means the instruction set the PC
+                    # itself (JMP, CALL, RET) or is a conditional jump (JEQ, JNE, ...)
+                    # that WILL be jumping. Every other handler returns None.
+                    jumping = handler(operand_a, operand_b)
+                except CPUFault as fault:
+                    self.take_fault(fault)
+                    trapped += 1
+                    continue
+                except IndexError:
+                    # the one way to index past the decode cache
+                    if pc <= 0xff:
+                        raise
+                    self.take_fault(PCOutOfRange(pc))
+                    trapped += 1
+                    continue
+                
+                # if the instruction did not set the PC itself,
+                # move past it and its operands
+                if not jumping:
+                    self.pc = pc + instruction_length
             else:
-                print(f'Unknown instruction {ir} at address {self.pc}')
-                sys.exit(1)
+                # ran the whole slice
+                executed = count
+        finally:
+            executed -= trapped
+            self.instruction_count += executed
+            self.output.flush()
+            
+        return executed
@@ -0,0 +1,141 @@
+"""
+Devices for the CPU: input devices that raise interrupts, and devices that
+sit on the memory bus (see CPU.map_device).
+
+A bus device claims one or more RAM addresses. LD and ST on those addresses
+call the device's read(address) and write(address, value) instead of
+touching RAM. A device is `deterministic` if a program using it always
+gets the same results, which is what lets its runs be cached (see
+cache.py).
+"""
+
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+# where attach_devices() maps the console and timer. The spec leaves
+# 0xF5-0xF7 reserved, between the key latch and the interrupt vectors
+CONSOLE_PORT = 0xf5
+TIMER_REGISTER = 0xf6
+
+
+class Keyboard:
+    """
+    Reads keys from a file descriptor (stdin by default) on a background
+    thread, so the CPU never blocks waiting for input. The CPU collects the
+    keys with read_key() when it polls for interrupts.
+
+    On the bus, the keyboard is the key latch at KEY_PRESSED (0xF4): reading
+    it gives the most recent key the CPU collected.
+    """
+
+    # keys come whenever they're typed
+    deterministic = False
+
+    def __init__(self, fd=None):
+        self.fd = fd if fd is not None else sys.stdin.fileno()
+
+        # keys pressed but not yet collected by the CPU. deque appends and
+        # pops are atomic, so the reader thread needs no lock
+        self.keys = deque()
+
+        # the last key collected, as read back through the bus
+        self.latch = 0
+
+        self.thread = None
+        self.saved_terminal = None
+
+    def start(self):
+        """Start reading keys in the background."""
+
+        # hand keys over as they're typed rather than a line at a time
+        if os.isatty(self.fd):
+            import termios
+            import tty
+
+            self.saved_terminal = termios.tcgetattr(self.fd)
+            tty.setcbreak(self.fd)
+            atexit.register(self.stop)
+
+        self.thread = threading.Thread(target=self.read_keys, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Put the terminal back the way we found it."""
+
+        if self.saved_terminal is not None:
+            import termios
+
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved_terminal)
+            self.saved_terminal = None
+
+    def read_keys(self):
+        # runs on the reader thread until end of input
+        while True:
+            key = os.read(self.fd, 1)
+            if not key:
+                break
+            self.keys.append(key[0])
+
+    def read_key(self):
+        """The next key pressed, or None if there isn't one."""
+
+        if self.keys:
+            self.latch = self.keys.popleft()
+            return self.latch
+
+        return None
+
+    def read(self, address):
+        return self.latch
+
+    def write(self, address, value):
+        # programs may clear the latch once they've handled a key
+        self.latch = value
+
+
+class Console:
+    """
+    A console port. Every byte stored to it is printed as a character on
+    the given output device, like PRA. Reads give 0.
+    """
+
+    deterministic = True
+
+    def __init__(self, output):
+        self.output = output
+
+    def read(self, address):
+        return 0
+
+    def write(self, address, value):
+        self.output.write(chr(value))
+
+
+class Timer:
+    """
+    A free-running timer register, counting whole seconds (modulo 256)
+    since it was created or last stored to. Storing a value sets the count.
+    """
+
+    # reads the wall clock
+    deterministic = False
+
+    def __init__(self):
+        self.start = time.monotonic()
+
+    def read(self, address):
+        return int(time.monotonic() - self.start) & 0xff
+
+    def write(self, address, value):
+        self.start = time.monotonic() - value
+
+
+def attach_devices(cpu):
+    """Map the console and timer onto a CPU's bus at their usual addresses."""
+
+    cpu.map_device(Console(cpu.output), CONSOLE_PORT)
+    cpu.map_device(Timer(), TIMER_REGISTER)
@@ -0,0 +1,478 @@
+"""Basic-block compiler backend for the CPU."""
+
+import re
+from cpu import *
+
+# instructions that end a basic block--after any of these the
+# next instruction to run isn't known until runtime
+BLOCK_ENDS = {JMP, JEQ, JNE, JGT, JLT, JGE, JLE, CALL, RET, HLT}
+
+
+class JITCPU(CPU):
+    """
+    CPU that compiles straight-line runs of instructions (basic blocks) into
+    one generated Python function each, instead of dispatching every
+    instruction through its own method.
+
+    A compiled block pulls the registers it touches into locals, runs all of
+    its instructions on those locals, writes them back and returns the
+    address of the next block to run. Compiling costs far more than
+    interpreting a block once, so this only wins on programs that loop--see
+    bench/README.md.
+    """
+
+    def __init__(self, output=None, keyboard=None):
+        """Construct a new JIT CPU."""
+
+        super().__init__(output, keyboard)
+
+        # compiled blocks, keyed by their start address
+        self.blocks = {}
+
+        # for every RAM address, the start addresses of the compiled
+        # blocks whose code covers it--used to throw blocks away when
+        # a write lands inside them
+        self.block_owners = [None] * 256
+
+        # branch table of code generators, one per opcode
+        self.emitters = {}
+        self.emitters[LDI] = self.emit_LDI
+        self.emitters[PRN] = self.emit_PRN
+        self.emitters[HLT] = self.emit_HLT
+        self.emitters[MUL] = self.emit_MUL
+        self.emitters[ADD] = self.emit_ADD
+        self.emitters[PUSH] = self.emit_PUSH
+        self.emitters[POP] = self.emit_POP
+        self.emitters[CMP] = self.emit_CMP
+        self.emitters[JMP] = self.emit_JMP
+        self.emitters[JEQ] = self.emit_JEQ
+        self.emitters[JNE] = self.emit_JNE
+        self.emitters[JGT] = self.emit_JGT
+        self.emitters[JLT] = self.emit_JLT
+        self.emitters[JGE] = self.emit_JGE
+        self.emitters[JLE] = self.emit_JLE
+        self.emitters[CALL] = self.emit_CALL
+        self.emitters[RET] = self.emit_RET
+        self.emitters[AND] = self.emit_AND
+        self.emitters[OR] = self.emit_OR
+        self.emitters[XOR] = self.emit_XOR
+        self.emitters[NOT] = self.emit_NOT
+        self.emitters[MOD] = self.emit_MOD
+        self.emitters[SHL] = self.emit_SHL
+        self.emitters[SHR] = self.emit_SHR
+        self.emitters[SUB] = self.emit_SUB
+        self.emitters[DIV] = self.emit_DIV
+        self.emitters[INC] = self.emit_INC
+        self.emitters[DEC] = self.emit_DEC
+        self.emitters[PRA] = self.emit_PRA
+        self.emitters[LD] = self.emit_LD
+        self.emitters[ST] = self.emit_ST
+
+    def ram_write(self, mar, mdr):
+        super().ram_write(mar, mdr)
+        self.invalidate_blocks(mar)
+
+    def ram_write_block(self, mar, data):
+        super().ram_write_block(mar, data)
+        for address in range(mar, mar + len(data)):
+            self.invalidate_blocks(address)
+
+    def clear_caches(self):
+        super().clear_caches()
+        self.blocks = {}
+        self.block_owners = [None] * 256
+
+    def fork(self, output=None):
+        child = super().fork(output)
+
+        # compiled blocks take the CPU as an argument, so the child can use
+        # the same ones. It gets its own tables of them, so blocks it throws
+        # away on a write stay compiled for the parent
+        child.blocks = dict(self.blocks)
+        child.block_owners = [
+            None if owners is None else list(owners)
+            for owners in self.block_owners
+        ]
+
+        return child
+
+    def invalidate_blocks(self, mar):
+        # throw away every compiled block that covers this address
+        owners = self.block_owners[mar]
+        if owners is not None:
+            for start in owners:
+                self.blocks.pop(start, None)
+            self.block_owners[mar] = None
+
+    def compile_block(self, start):
+        """
+        Compile the basic block starting at the given address into a Python
+        function, cache it and return it. Returns None if the first
+        instruction is not in the instruction set.
+        """
+
+        # the generated statements for the block body
+        body = []
+
+        # which registers the block touches, and whether it uses FL
+        self.used_regs = set()
+        self.written_regs = set()
+        self.uses_fl = False
+        self.writes_fl = False
+
+        self.compiling_start = start
+
+        address = start
+        count = 0
+
+        while True:
+            # stop at the top of RAM or at an instruction we can't compile--
+            # the block falls through to it and it gets handled when
+            # the run loop tries to compile a block starting there
+            if address > 0xff or self.ram[address] not in self.emitters:
+                body.append(("exit", address, count))
+                break
+
+            ir = self.ram[address]
+            operand_a = self.ram[(address + 1) & 0xff]
+            operand_b = self.ram[(address + 2) & 0xff]
+            instruction_length = ((ir & 0b11000000) >> 6) + 1
+
+            # bad registers are left to the interpreter to fault on too
+            if bad_registers(ir, operand_a, operand_b):
+                body.append(("exit", address, count))
+                break
+
+            count += 1
+
+            # tag every way out of the block with how many instructions
+            # have run by the time it's taken
+            for statement in self.emitters[ir](address, operand_a, operand_b):
+                if not isinstance(statement, str):
+                    statement = statement + (count,)
+                body.append(statement)
+
+            address += instruction_length
+
+            if ir in BLOCK_ENDS:
+                break
+
+        # nothing compiled at all--the first instruction is unknown
+        if address == start:
+            return None
+
+        source = self.render_block(start, body)
+
+        # compiled branches look up the same precomputed tables as the
+        # interpreter's
+        namespace = {"DivisionByZero": DivisionByZero}
+        for op, taken in BRANCH_TAKEN.items():
+            namespace[f"{OPCODE_NAMES[op]}_TAKEN"] = taken
+        exec(compile(source, f"<ls8 block {start:#04x}>", "exec"), namespace)
+        block = namespace["block"]
+
+        # remember the block and every address its code covers
+        self.blocks[start] = block
+        for covered in range(start, min(address, 256)):
+            if self.block_owners[covered] is None:
+                self.block_owners[covered] = []
+            self.block_owners[covered].append(start)
+
+        return block
+
+    def render_block(self, start, body):
+        """
+        Turn the emitted statements into the source of a `block(cpu, budget)`
+        function. Statements are plain strings, except for the tuples
+        ("exit", next_pc, count) and ("exit_if", condition, next_pc, count)
+        that write the locals back, add the number of instructions run to
+        the CPU's count and leave the block, and ("fault_if", condition,
+        address, fault, count) that does the same but leaves by raising the
+        fault from the instruction at that address.
+
+        A block whose jump can land back on its own start loops right there
+        instead of returning, as long as fewer than `budget` instructions
+        have run--going back through the run loop costs more than a short
+        block itself.
+        """
+
+        # registers come in as locals r0-r7 and go back out
+        # only if the block changed them
+        load = [f"r{r} = reg[{r}]" for r in sorted(self.used_regs)]
+        store = [f"reg[{r}] = r{r}" for r in sorted(self.written_regs)]
+
+        if self.uses_fl:
+            load.append("fl = cpu.fl")
+        if self.writes_fl:
+            store.append("cpu.fl = fl")
+
+        # only exits to a register can come back here--a constant one is
+        # always past the start
+        loops = any(
+            statement[0] != "fault_if" and isinstance(statement[-2], str)
+            for statement in body if not isinstance(statement, str)
+        )
+        indent = "        " if loops else "    "
+        ran = "ran + " if loops else ""
+
+        lines = []
+
+        def leave(pad, next_pc, count):
+            # only if this block is still compiled--a store on the way
+            # round, like CALL's return address, can have thrown it away
+            if loops and isinstance(next_pc, str):
+                lines.append(f"{pad}if {next_pc} == {start} and ran + {count} < budget "
+                             f"and {start} in blocks:")
+                lines.append(f"{pad}    ran += {count}")
+                lines.append(f"{pad}    continue")
+            lines.extend(pad + s for s in store)
+            lines.append(f"{pad}cpu.instruction_count += {ran}{count}")
+            lines.append(f"{pad}return {next_pc}")
+
+        for statement in body:
+            if isinstance(statement, str):
+                lines.append(indent + statement)
+            elif statement[0] == "exit":
+                leave(indent, statement[1], statement[2])
+            elif statement[0] == "fault_if":
+                # the faulting instruction itself hasn't run, and the
+                # PC is left on it for take_fault()
+                lines.append(f"{indent}if {statement[1]}:")
+                lines.extend(indent + "    " + s for s in store)
+                lines.append(f"{indent}    cpu.instruction_count += {ran}{statement[4] - 1}")
+                lines.append(f"{indent}    cpu.pc = {statement[2]}")
+                lines.append(f"{indent}    raise {statement[3]}")
+            else:
+                # conditional exit: write back and leave if true
+                lines.append(f"{indent}if {statement[1]}:")
+                leave(indent + "    ", statement[2], statement[3])
+
+        # pull in only the parts of the CPU the code uses
+        code = "\n".join(load + lines)
+        prologue = [
+            f"    {name} = cpu.{name}"
+            for name in ("reg", "ram", "ram_write", "devices", "blocks", "output")
+            if re.search(rf"\b{name}\b", code)
+        ]
+        prologue.extend("    " + s for s in load)
+
+        if loops:
+            prologue.append("    ran = 0")
+            prologue.append("    while True:")
+
+        return "\n".join(["def block(cpu, budget):"] + prologue + lines) + "\n"
+
+    def read(self, *regs):
+        # note that the block reads these registers
+        self.used_regs.update(regs)
+
+    def write(self, *regs):
+        # note that the block reads and changes these registers
+        self.used_regs.update(regs)
+        self.written_regs.update(regs)
+
+    def emit_LDI(self, address, reg_num, value):
+        self.write(reg_num)
+        return [f"r{reg_num} = {value}"]
+
+    def emit_PRN(self, address, reg_num, _):
+        self.read(reg_num)
+        return [f"output.write(f'{{r{reg_num}}}\\n')"]
+
+    def emit_PRA(self, address, reg_num, _):
+        self.read(reg_num)
+        return [f"output.write(chr(r{reg_num}))"]
+
+    def emit_HLT(self, address, *_):
+        return ["cpu.running = False", "output.flush()", ("exit", address + 1)]
+
+    def emit_alu(self, reg_a, reg_b, expression):
+        # two-register ALU op writing its result to reg_a
+        self.read(reg_b)
+        self.write(reg_a)
+        return [f"r{reg_a} = " + expression.format(a=f"r{reg_a}", b=f"r{reg_b}")]
+
+    def emit_MUL(self, address, reg_a, reg_b):
+        return self.emit_alu(reg_a, reg_b, "({a} * {b}) & 0xff")
+
+    def emit_ADD(self, address, reg_a, reg_b):
+        return self.emit_alu(reg_a, reg_b, "({a} + {b}) & 0xff")
+
+    def emit_AND(self, address, reg_a, reg_b):
+        return self.emit_alu(reg_a, reg_b, "{a} & {b}")
+
+    def emit_OR(self, address, reg_a, reg_b):
+        return self.emit_alu(reg_a, reg_b, "{a} | {b}")
+
+    def emit_XOR(self, address, reg_a, reg_b):
+        return self.emit_alu(reg_a, reg_b, "{a} ^ {b}")
+
+    def emit_SHL(self, address, reg_a, reg_b):
+        return self.emit_alu(reg_a, reg_b, "({a} << {b}) & 0xff")
+
+    def emit_SHR(self, address, reg_a, reg_b):
+        return self.emit_alu(reg_a, reg_b, "{a} >> {b}")
+
+    def emit_NOT(self, address, reg_num, _):
+        self.write(reg_num)
+        return [f"r{reg_num} = ~r{reg_num} & 0xff"]
+
+    def emit_SUB(self, address, reg_a, reg_b):
+        return self.emit_alu(reg_a, reg_b, "({a} - {b}) & 0xff")
+
+    def emit_INC(self, address, reg_num, _):
+        self.write(reg_num)
+        return [f"r{reg_num} = (r{reg_num} + 1) & 0xff"]
+
+    def emit_DEC(self, address, reg_num, _):
+        self.write(reg_num)
+        return [f"r{reg_num} = (r{reg_num} - 1) & 0xff"]
+
+    def emit_division(self, address, op, reg_a, reg_b, operator):
+        # DIV and MOD fault on a zero divisor, just like CPU.alu
+        self.read(reg_b)
+        self.write(reg_a)
+        return [
+            ("fault_if", f"r{reg_b} == 0", address, f"DivisionByZero({address}, {op})"),
+            f"r{reg_a} = r{reg_a} {operator} r{reg_b}",
+        ]
+
+    def emit_DIV(self, address, reg_a, reg_b):
+        return self.emit_division(address, DIV, reg_a, reg_b, "//")
+
+    def emit_MOD(self, address, reg_a, reg_b):
+        return self.emit_division(address, MOD, reg_a, reg_b, "%")
+
+    def emit_CMP(self, address, reg_a, reg_b):
+        self.read(reg_a, reg_b)
+        self.uses_fl = True
+        self.writes_fl = True
+        return [f"fl = 1 if r{reg_a} == r{reg_b} else 2 if r{reg_a} > r{reg_b} else 4"]
+
+    def emit_PUSH(self, address, reg_num, _):
+        SP = 7
+        self.read(reg_num)
+        self.write(SP)
+        return [
+            "r7 = (r7 - 1) & 0xff",
+            f"ram_write(r7, r{reg_num})",
+            # if the write landed in this block's own code the block has
+            # just been thrown away--leave so the rest gets recompiled
+            ("exit_if", f"{self.compiling_start} not in blocks", address + 2),
+        ]
+
+    def emit_POP(self, address, reg_num, _):
+        SP = 7
+        self.write(SP, reg_num)
+        return [f"r{reg_num} = ram[r7]", "r7 = (r7 + 1) & 0xff"]
+
+    def emit_LD(self, address, reg_a, reg_b):
+        self.read(reg_b)
+        self.write(reg_a)
+        # plain RAM is read directly, mapped addresses through the bus
+        return [
+            f"r{reg_a} = ram[r{reg_b}] if devices[r{reg_b}] is None "
+            f"else cpu.bus_read(r{reg_b})"
+        ]
+
+    def emit_ST(self, address, reg_a, reg_b):
+        self.read(reg_a, reg_b)
+        return [
+            f"ram_write(r{reg_a}, r{reg_b}) if devices[r{reg_a}] is None "
+            f"else cpu.bus_write(r{reg_a}, r{reg_b})",
+            # leave if the store just threw this block away
+            ("exit_if", f"{self.compiling_start} not in blocks", address + 3),
+        ]
+
+    def emit_JMP(self, address, reg_num, _):
+        self.read(reg_num)
+        return [("exit", f"r{reg_num}")]
+
+    def emit_branch(self, name, address, reg_num):
+        # leave for the target if the branch is taken, otherwise for
+        # the instruction after it
+        self.read(reg_num)
+        self.uses_fl = True
+        return [("exit_if", f"{name}_TAKEN[fl]", f"r{reg_num}"), ("exit", address + 2)]
+
+    def emit_JEQ(self, address, reg_num, _):
+        return self.emit_branch("JEQ", address, reg_num)
+
+    def emit_JNE(self, address, reg_num, _):
+        return self.emit_branch("JNE", address, reg_num)
+
+    def emit_JGT(self, address, reg_num, _):
+        return self.emit_branch("JGT", address, reg_num)
+
+    def emit_JLT(self, address, reg_num, _):
+        return self.emit_branch("JLT", address, reg_num)
+
+    def emit_JGE(self, address, reg_num, _):
+        return self.emit_branch("JGE", address, reg_num)
+
+    def emit_JLE(self, address, reg_num, _):
+        return self.emit_branch("JLE", address, reg_num)
+
+    def emit_CALL(self, address, reg_num, _):
+        SP = 7
+        self.read(reg_num)
+        self.write(SP)
+        # the return address is pushed before the target is read,
+        # just like CPU.CALL
+        return ["r7 = (r7 - 1) & 0xff", f"ram_write(r7, {(address + 2) & 0xff})", ("exit", f"r{reg_num}")]
+
+    def emit_RET(self, address, *_):
+        SP = 7
+        self.write(SP)
+        return ["return_addr = ram[r7]", "r7 = (r7 + 1) & 0xff", ("exit", "return_addr")]
+
+    def run_slice(self, count):
+        """
+        Check for interrupts, then run compiled blocks until at least `count`
+        instructions have run or the program halts. Returns the number of
+        instructions run--a slice ends on a block boundary, so it can go a
+        little over `count`. Faults are dealt with as in CPU.run_slice().
+        """
+
+        self.poll_interrupts()
+
+        blocks = self.blocks
+        start_count = self.instruction_count
+        target = start_count + count
+
+        try:
+            while self.running and self.instruction_count < target:
+                pc = self.pc
+
+                try:
+                    block = blocks.get(pc)
+
+                    # compile the block the first time we land on it
+                    if block is None:
+                        if pc > 0xff:
+                            raise PCOutOfRange(pc)
+                        block = self.compile_block(pc)
+
+                    if block is None:
+                        # nothing to compile--run this one instruction through
+                        # the interpreter's handler instead (INT, IRET, and
+                        # anything with a bad register, which faults here)
+                        entry = self.decode(pc)
+
+                        if entry is None:
+                            raise UnknownInstruction(pc, self.ram[pc])
+
+                        handler, operand_a, operand_b, instruction_length = entry
+                        if not handler(operand_a, operand_b):
+                            self.pc += instruction_length
+                        self.instruction_count += 1
+                        continue
+
+                    # run the whole block and move to wherever it ended up
+                    self.pc = block(self, target - self.instruction_count)
+                except CPUFault as fault:
+                    self.take_fault(fault)
+        finally:
+            self.output.flush()
+
+        return self.instruction_count - start_count
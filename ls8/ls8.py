@@ -2,10 +2,153 @@
 
 """Main."""
 
+import argparse
 import sys
-from cpu import *
+from cpu import BUDGET_EXHAUSTED, FAULTED, CPUFault
+from runner import ENGINES, run_parallel
+from profiler import Profiler
+from tracer import TraceRecorder
+from devices import Keyboard, attach_devices
+from analyzer import analyze
+from cache import ResultCache, CACHE_MAX_BYTES
 
-cpu = CPU()
+parser = argparse.ArgumentParser(description="Run LS-8 programs.")
+parser.add_argument("programs", nargs="+", metavar="program.ls8",
+                    help="program(s) to run")
+parser.add_argument("--engine", choices=ENGINES, default="interp",
+                    help="execution engine to run programs on; jit only pays off "
+                         "on long-running loops (see bench/README.md)")
+parser.add_argument("--parallel", type=int, metavar="N",
+                    help="run every program on a pool of N worker processes "
+                         "and print a JSON-lines report")
+parser.add_argument("--profile", action="store_true",
+                    help="profile the run and print a report to stderr")
+parser.add_argument("--profile-json", metavar="FILE",
+                    help="profile the run and write the profile as JSON")
+parser.add_argument("--trace", metavar="FILE",
+                    help="record a binary execution trace to FILE "
+                         "(decode it with tracer.py)")
+parser.add_argument("--max-instructions", type=int, metavar="N",
+                    help="stop the program after N instructions")
+parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                    help="stop the program after SECONDS of wall-clock time")
+parser.add_argument("--trap-faults", action="store_true",
+                    help="hand faults to the program's handler at I7's "
+                         "vector instead of stopping")
+parser.add_argument("--cache", metavar="DIR",
+                    help="reuse the results of earlier identical runs, "
+                         "kept in DIR")
+parser.add_argument("--cache-size", type=int, default=CACHE_MAX_BYTES >> 20,
+                    metavar="MB",
+                    help="keep the cache under MB megabytes (default 64)")
+parser.add_argument("--check", action="store_true",
+                    help="analyze the program first, and don't run it if "
+                         "it could loop forever or overflow its stack")
+parser.add_argument("--keyboard", action="store_true",
+                    help="take keys from the terminal even if the program "
+                         "doesn't seem to use them")
+parser.add_argument("--trace-records", type=int, default=1 << 20, metavar="N",
+                    help="keep the last N trace records (default 1048576)")
+args = parser.parse_args()
 
-cpu.load()
-cpu.run()
\ No newline at end of file
+# the profiler and the tracer step the interpreter themselves, one
+# instruction at a time, to the end of the program
+inspecting = args.profile or args.profile_json or args.trace
+if inspecting:
+    option = "--trace" if args.trace else "--profile"
+    if args.parallel is not None:
+        parser.error(f"{option} can't be combined with --parallel")
+    if args.engine != "interp":
+        parser.error(f"{option} only works with --engine=interp")
+    for flag, value in (("--max-instructions", args.max_instructions),
+                        ("--timeout", args.timeout),
+                        ("--cache", args.cache)):
+        if value is not None:
+            parser.error(f"{option} can't be combined with {flag}")
+
+if args.parallel is not None:
+    failures = run_parallel(args.programs, args.parallel, args.engine,
+                            max_instructions=args.max_instructions,
+                            timeout=args.timeout,
+                            trap_faults=args.trap_faults,
+                            cache_dir=args.cache,
+                            cache_max_bytes=args.cache_size << 20)
+    sys.exit(1 if failures else 0)
+
+if len(args.programs) > 1:
+    parser.error("more than one program needs --parallel N")
+
+if args.trace and (args.profile or args.profile_json):
+    parser.error("--trace can't be combined with --profile")
+
+cpu = ENGINES[args.engine]()
+cpu.trap_faults = args.trap_faults
+attach_devices(cpu)
+
+try:
+    cpu.load(args.programs[0])
+except (OSError, ValueError) as e:
+    print(e)
+    sys.exit(1)
+
+# analyze the program for --check, and to see whether it needs the
+# keyboard (unless --keyboard says so already)
+wants_keyboard = args.keyboard
+if args.check or (sys.stdin.isatty() and not wants_keyboard):
+    analysis = analyze(cpu.ram_dump(), cpu.symbols)
+    wants_keyboard = wants_keyboard or analysis.uses_keyboard()
+
+if args.check:
+    for warning in analysis.warnings:
+        print(f"{args.programs[0]}: {warning}", file=sys.stderr)
+    if analysis.warnings:
+        sys.exit(1)
+
+# keys typed at a terminal raise keyboard interrupts. Reading them means
+# putting the terminal in cbreak mode, so only for programs that can
+# take them
+if sys.stdin.isatty() and wants_keyboard:
+    keyboard = Keyboard()
+    keyboard.start()
+    cpu.attach_keyboard(keyboard)
+
+if args.profile or args.profile_json:
+    profiler = Profiler()
+
+    # report even if the program stops with an error
+    try:
+        profiler.run(cpu)
+    except CPUFault as fault:
+        print(fault)
+        sys.exit(1)
+    finally:
+        if args.profile:
+            profiler.report()
+        if args.profile_json:
+            profiler.write_json(args.profile_json)
+elif args.trace:
+    recorder = TraceRecorder(args.trace_records, args.trace)
+
+    # keep the trace even if the program stops with an error
+    try:
+        recorder.run(cpu)
+    except CPUFault as fault:
+        print(fault)
+        sys.exit(1)
+    finally:
+        recorder.close()
+else:
+    if args.cache:
+        cache = ResultCache(args.cache, args.cache_size << 20)
+        result = cache.run(cpu, args.max_instructions, args.timeout)
+    else:
+        result = cpu.run(args.max_instructions, args.timeout)
+
+    if result.status == BUDGET_EXHAUSTED:
+        print(f"stopped after {result.instructions} instructions "
+              f"({result.elapsed:.2f}s): budget exhausted", file=sys.stderr)
+        # the same status timeout(1) uses
+        sys.exit(124)
+    elif result.status == FAULTED:
+        print(result.error)
+        sys.exit(1)
@@ -0,0 +1,62 @@
+"""Output devices the CPU prints to."""
+
+import sys
+
+
+class BufferedOutput:
+    """
+    Default output device. Collects everything the CPU prints and writes it
+    to the stream in one go when the buffer passes `limit` characters, on
+    flush(), and when the CPU halts.
+    """
+
+    def __init__(self, stream=None, limit=8192):
+        # stream defaults to whatever sys.stdout is at flush time
+        self.stream = stream
+        self.limit = limit
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+
+        if self.size >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            stream = self.stream if self.stream is not None else sys.stdout
+            stream.write("".join(self.buffer))
+            stream.flush()
+
+            self.buffer = []
+            self.size = 0
+
+
+class CaptureOutput:
+    """Output device that keeps everything printed in memory."""
+
+    def __init__(self):
+        self.buffer = []
+
+    def write(self, text):
+        self.buffer.append(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        """Everything printed so far, as one string."""
+
+        return "".join(self.buffer)
+
+
+class NullOutput:
+    """Output device that throws everything away, for benchmarking."""
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
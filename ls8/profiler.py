@@ -0,0 +1,203 @@
+"""Opt-in instruction profiler for the CPU."""
+
+import json
+import sys
+from cpu import *
+
+# conditional branches whose taken/not-taken counts are recorded
+BRANCHES = set(BRANCH_TAKEN)
+
+
+class Profiler:
+    """
+    Runs a CPU on its own copy of the dispatch loop, counting executions per
+    opcode and per address, taken and not-taken conditional branches, and
+    instructions spent inside each CALL'd subroutine. CPU.run itself is left
+    untouched, so profiling costs nothing when it's off.
+    """
+
+    def __init__(self):
+        """Construct an empty profile."""
+
+        # executions per opcode and per address
+        self.opcode_counts = [0] * 256
+        self.address_counts = [0] * 256
+
+        # branch address -> [taken, not taken]
+        self.branch_counts = {}
+
+        # subroutine address -> [calls, instructions run inside it,
+        # including anything it calls in turn]
+        self.subroutines = {}
+
+        # instructions run under each call stack, keyed like
+        # "main;0x18;0x2a"--the folded format flame graph tools read
+        self.stacks = {}
+
+        self.total = 0
+        self.symbols = {}
+
+    def run(self, cpu):
+        """Run the CPU until it halts, profiling every instruction."""
+
+        cpu.running = True
+
+        # every instruction is counted on its own, so decode them
+        # without fusing common sequences together
+        fuse = cpu.fuse
+        cpu.fuse = False
+        cpu.clear_caches()
+        self.symbols = cpu.symbols
+
+        decoded = cpu.decoded
+        ram = cpu.ram
+
+        opcode_counts = self.opcode_counts
+        address_counts = self.address_counts
+        branch_counts = self.branch_counts
+        stacks = self.stacks
+
+        # (subroutine address, instruction count when it was called)
+        call_stack = []
+        stack_key = "main"
+
+        executed = 0
+
+        # instructions left before the next interrupt check
+        countdown = 1
+
+        try:
+            while cpu.running:
+                countdown -= 1
+                if not countdown:
+                    countdown = INTERRUPT_CHECK_INTERVAL
+                    cpu.poll_interrupts()
+
+                pc = cpu.pc
+
+                try:
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = cpu.decode(pc)
+
+                        if entry is None:
+                            raise UnknownInstruction(pc, ram[pc])
+
+                    handler, operand_a, operand_b, instruction_length = entry
+
+                    # grab the opcode before the instruction can overwrite it
+                    ir = ram[pc]
+
+                    jumping = handler(operand_a, operand_b)
+                except CPUFault as fault:
+                    # a faulting instruction doesn't count as run
+                    cpu.take_fault(fault)
+                    continue
+                except IndexError:
+                    if pc <= 0xff:
+                        raise
+                    cpu.take_fault(PCOutOfRange(pc))
+                    continue
+
+                opcode_counts[ir] += 1
+                address_counts[pc] += 1
+                stacks[stack_key] = stacks.get(stack_key, 0) + 1
+
+                if not jumping:
+                    cpu.pc = pc + instruction_length
+
+                executed += 1
+
+                if ir in BRANCHES:
+                    counts = branch_counts.setdefault(pc, [0, 0])
+                    counts[0 if jumping else 1] += 1
+
+                elif ir == CALL:
+                    # the CALL has already moved the PC to the subroutine
+                    call_stack.append((cpu.pc, executed))
+                    stack_key += f";{self.name(cpu.pc)}"
+
+                elif ir == RET and call_stack:
+                    address, called_at = call_stack.pop()
+                    stats = self.subroutines.setdefault(address, [0, 0])
+                    stats[0] += 1
+                    stats[1] += executed - called_at
+                    stack_key = stack_key.rsplit(";", 1)[0]
+        finally:
+            cpu.fuse = fuse
+            cpu.clear_caches()
+            cpu.instruction_count += executed
+            cpu.output.flush()
+            self.total += executed
+
+    def name(self, address):
+        """The label for an address if the program has one, else its hex."""
+
+        for label, label_address in self.symbols.items():
+            if label_address == address:
+                return label
+
+        return f"{address:#04x}"
+
+    def to_dict(self):
+        """The profile as plain data, ready to be dumped as JSON."""
+
+        return {
+            "instructions": self.total,
+            "opcodes": {
+                OPCODE_NAMES.get(op, f"{op:#04x}"): count
+                for op, count in enumerate(self.opcode_counts) if count
+            },
+            "addresses": {
+                f"{address:#04x}": count
+                for address, count in enumerate(self.address_counts) if count
+            },
+            "branches": {
+                f"{address:#04x}": {"taken": taken, "not_taken": not_taken}
+                for address, (taken, not_taken) in sorted(self.branch_counts.items())
+            },
+            "subroutines": {
+                self.name(address): {"calls": calls, "instructions": cycles}
+                for address, (calls, cycles) in sorted(self.subroutines.items())
+            },
+            "stacks": self.stacks,
+        }
+
+    def write_json(self, filename):
+        """Write the profile as JSON."""
+
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def report(self, out=sys.stderr, top=10):
+        """Print a human-readable summary of the profile."""
+
+        print(f"{self.total} instructions executed", file=out)
+
+        print("\nOpcodes:", file=out)
+        ops = sorted(
+            (count, op) for op, count in enumerate(self.opcode_counts) if count
+        )
+        for count, op in reversed(ops):
+            name = OPCODE_NAMES.get(op, f"{op:#04x}")
+            print(f"  {name:<6} {count:>10}", file=out)
+
+        print(f"\nHottest addresses (top {top}):", file=out)
+        hot = sorted(
+            (count, address)
+            for address, count in enumerate(self.address_counts) if count
+        )
+        for count, address in reversed(hot[-top:]):
+            print(f"  {address:#04x}   {count:>10}", file=out)
+
+        if self.branch_counts:
+            print("\nBranches:", file=out)
+            for address, (taken, not_taken) in sorted(self.branch_counts.items()):
+                print(f"  {address:#04x}   taken {taken:>8}  not taken {not_taken:>8}",
+                      file=out)
+
+        if self.subroutines:
+            print("\nSubroutines:", file=out)
+            for address, (calls, cycles) in sorted(self.subroutines.items()):
+                print(f"  {self.name(address):<16} calls {calls:>8}  instructions {cycles:>10}",
+                      file=out)
@@ -0,0 +1,111 @@
+"""Run many LS-8 programs at once across a pool of worker processes."""
+
+import json
+import sys
+from multiprocessing import Pool
+
+from cpu import *
+from jit import JITCPU
+from output import CaptureOutput
+from devices import attach_devices
+from cache import ResultCache, CACHE_MAX_BYTES
+
+# execution engines selectable with --engine=NAME
+ENGINES = {
+    "interp": CPU,
+    "jit": JITCPU,
+}
+
+
+def run_program(filename, engine="interp", max_instructions=None, timeout=None,
+                trap_faults=False, cache_dir=None, cache_max_bytes=CACHE_MAX_BYTES):
+    """
+    Load and run one program on a fresh CPU, capturing everything it prints.
+    Returns a dict with the program's stdout, exit status, how the run
+    ended (see RunResult), any fault and the instruction count. Budgets
+    and trap_faults are as for CPU.run() and CPU.take_fault(). With a
+    cache_dir, results are looked up in and saved to a ResultCache there,
+    kept under cache_max_bytes.
+    """
+
+    output = CaptureOutput()
+    cpu = ENGINES[engine](output)
+    cpu.trap_faults = trap_faults
+    attach_devices(cpu)
+    status = 0
+    outcome = None
+    error = None
+    fault = None
+    cached = False
+
+    try:
+        cpu.load(filename)
+        if cache_dir is None:
+            run = cpu.run(max_instructions, timeout)
+        else:
+            cache = ResultCache(cache_dir, cache_max_bytes)
+            run = cache.run(cpu, max_instructions, timeout)
+            cached = run.cached
+        outcome = run.status
+        error = run.error
+        fault = run.fault
+        # exit statuses as ls8.py would give them
+        status = {HALTED: 0, FAULTED: 1, BUDGET_EXHAUSTED: 124}[outcome]
+    except (OSError, ValueError) as e:
+        # the program couldn't be loaded
+        status = 1
+        error = str(e)
+    except Exception as e:
+        # anything else is a crash in the emulator itself
+        status = 1
+        error = repr(e)
+
+    result = {
+        "program": filename,
+        "status": status,
+        "result": outcome,
+        "instructions": cpu.instruction_count,
+        "stdout": output.getvalue(),
+    }
+
+    if error is not None:
+        result["error"] = error
+    if fault is not None:
+        result["fault"] = fault.to_dict()
+    if cached:
+        result["cached"] = True
+
+    return result
+
+
+def _run_program_args(args):
+    # Pool.imap hands over a single argument
+    return run_program(*args)
+
+
+def run_parallel(filenames, workers, engine="interp", out=sys.stdout,
+                 max_instructions=None, timeout=None, trap_faults=False,
+                 cache_dir=None, cache_max_bytes=CACHE_MAX_BYTES):
+    """
+    Run every program in its own CPU on a pool of worker processes and write
+    one JSON object per program to out, in the order the programs were given.
+    Each program gets its own instruction and time budget, if given. A
+    program that faults is reported as such without affecting the others.
+    The workers can share one result cache directory.
+    Returns the number of programs that did not exit cleanly.
+    """
+
+    failures = 0
+
+    with Pool(workers) as pool:
+        jobs = [
+            (filename, engine, max_instructions, timeout, trap_faults,
+             cache_dir, cache_max_bytes)
+            for filename in filenames
+        ]
+        for result in pool.imap(_run_program_args, jobs):
+            if result["status"] != 0:
+                failures += 1
+            out.write(json.dumps(result) + "\n")
+
+    return failures
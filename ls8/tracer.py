@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+"""
+Low-overhead execution trace recorder for the CPU, and a decoder for the
+traces it writes.
+
+Usage: tracer.py trace.bin [other.bin]
+
+Prints the decoded trace, or the first place two traces diverge.
+"""
+
+import mmap
+import struct
+import sys
+from cpu import *
+
+# A trace is a header followed by a ring buffer of fixed-width records.
+#
+#   header: magic "LS8T", version (1 byte), record size (1 byte),
+#           reserved (2 bytes), capacity in records (4 bytes),
+#           total records ever written (8 bytes), all little-endian
+TRACE_MAGIC = b"LS8T"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sBBHIQ")
+
+RECORD_SIZE = 16
+
+# Record kinds. Memory writes are recorded as they happen, so the WRITE
+# records before a STEP or INTERRUPT record belong to it.
+#
+#   STEP:      kind, PC, opcode, operand A, operand B, FL after,
+#              2 pad bytes, R0-R7 after
+#   WRITE:     kind, address, old value, new value, 12 pad bytes
+#   INTERRUPT: kind, PC interrupted at, handler address, 13 pad bytes.
+#              Trapped faults (see CPU.take_fault) are recorded this way too
+STEP = 1
+WRITE = 2
+INTERRUPT = 3
+
+STEP_RECORD = struct.Struct("<BBBBBB2x8s")
+WRITE_RECORD = struct.Struct("<BBBB12x")
+INTERRUPT_RECORD = struct.Struct("<BBB13x")
+
+
+class TraceRecorder:
+    """
+    Runs a CPU on its own copy of the dispatch loop, appending a record for
+    every instruction, memory write and interrupt to a preallocated ring
+    buffer. Once the buffer is full the oldest records are overwritten, so
+    the most recent `capacity` records are always kept.
+
+    The buffer lives in memory, or in a memory-mapped file if a filename is
+    given, in which case the trace is on disk as soon as close() is called.
+    """
+
+    def __init__(self, capacity=1 << 20, filename=None):
+        self.capacity = capacity
+        self.total = 0
+
+        size = TRACE_HEADER.size + capacity * RECORD_SIZE
+
+        if filename is None:
+            self.file = None
+            self.buffer = bytearray(size)
+        else:
+            self.file = open(filename, "w+b")
+            self.file.truncate(size)
+            self.buffer = mmap.mmap(self.file.fileno(), size)
+
+        self.write_header()
+
+    def write_header(self):
+        TRACE_HEADER.pack_into(
+            self.buffer, 0, TRACE_MAGIC, TRACE_VERSION, RECORD_SIZE, 0,
+            self.capacity, self.total
+        )
+
+    def offset(self):
+        # where the next record goes in the ring buffer
+        return TRACE_HEADER.size + (self.total % self.capacity) * RECORD_SIZE
+
+    def record_write(self, cpu, mar, mdr):
+        WRITE_RECORD.pack_into(
+            self.buffer, self.offset(), WRITE, mar, cpu.ram[mar], mdr & 0xff
+        )
+        self.total += 1
+
+    def run(self, cpu):
+        """Run the CPU until it halts, recording every step."""
+
+        cpu.running = True
+
+        # every instruction is counted on its own, so decode them
+        # without fusing common sequences together
+        fuse = cpu.fuse
+        cpu.fuse = False
+        cpu.clear_caches()
+
+        # route the CPU's memory writes through the recorder while we run
+        cpu_ram_write = cpu.ram_write
+
+        def ram_write(mar, mdr):
+            self.record_write(cpu, mar, mdr)
+            cpu_ram_write(mar, mdr)
+
+        cpu.ram_write = ram_write
+
+        decoded = cpu.decoded
+        ram = cpu.ram
+        reg = cpu.reg
+        buffer = self.buffer
+        capacity = self.capacity
+        pack_step = STEP_RECORD.pack_into
+
+        executed = 0
+
+        # instructions left before the next interrupt check
+        countdown = 1
+
+        try:
+            while cpu.running:
+                countdown -= 1
+                if not countdown:
+                    countdown = INTERRUPT_CHECK_INTERVAL
+
+                    # keep the record count in the header current, so a
+                    # file-backed trace is readable even if we're killed
+                    self.write_header()
+
+                    pc = cpu.pc
+                    cpu.poll_interrupts()
+
+                    # an interrupt was taken
+                    if cpu.pc != pc:
+                        INTERRUPT_RECORD.pack_into(
+                            buffer, self.offset(), INTERRUPT, pc, cpu.pc
+                        )
+                        self.total += 1
+
+                pc = cpu.pc
+
+                try:
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = cpu.decode(pc)
+
+                        if entry is None:
+                            raise UnknownInstruction(pc, ram[pc])
+
+                    handler, operand_a, operand_b, instruction_length = entry
+
+                    # grab the opcode before the instruction can overwrite it
+                    ir = ram[pc]
+
+                    jumping = handler(operand_a, operand_b)
+                except (CPUFault, IndexError) as error:
+                    if isinstance(error, IndexError):
+                        if pc <= 0xff:
+                            raise
+                        error = PCOutOfRange(pc)
+
+                    # a trapped fault is recorded like an interrupt
+                    cpu.take_fault(error)
+                    INTERRUPT_RECORD.pack_into(
+                        buffer, self.offset(), INTERRUPT, pc & 0xff, cpu.pc
+                    )
+                    self.total += 1
+                    continue
+
+                if not jumping:
+                    cpu.pc = pc + instruction_length
+
+                executed += 1
+
+                offset = TRACE_HEADER.size + (self.total % capacity) * RECORD_SIZE
+                pack_step(buffer, offset, STEP, pc, ir, operand_a, operand_b,
+                          cpu.fl, bytes(reg))
+                self.total += 1
+        finally:
+            cpu.fuse = fuse
+            cpu.clear_caches()
+            del cpu.ram_write
+            cpu.instruction_count += executed
+            cpu.output.flush()
+            self.write_header()
+
+    def close(self):
+        """Finish the trace, writing it out if it's backed by a file."""
+
+        self.write_header()
+
+        if self.file is not None:
+            self.buffer.flush()
+            self.buffer.close()
+            self.file.close()
+            self.file = None
+
+    def save(self, filename):
+        """Write an in-memory trace out to a file."""
+
+        self.write_header()
+
+        with open(filename, "wb") as f:
+            f.write(self.buffer)
+
+
+class TraceReader:
+    """Decodes a trace written by TraceRecorder."""
+
+    def __init__(self, data):
+        magic, version, record_size, _, capacity, total = TRACE_HEADER.unpack_from(data)
+
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != RECORD_SIZE:
+            raise ValueError("Not an LS-8 trace, or an unsupported version")
+
+        self.data = data
+        self.capacity = capacity
+        self.total = total
+
+    @classmethod
+    def open(cls, filename):
+        with open(filename, "rb") as f:
+            return cls(f.read())
+
+    def records(self):
+        """
+        Yield the records still in the ring buffer, oldest first, as
+        (index, kind, fields) tuples.
+        """
+
+        first = max(0, self.total - self.capacity)
+
+        for index in range(first, self.total):
+            offset = TRACE_HEADER.size + (index % self.capacity) * RECORD_SIZE
+            kind = self.data[offset]
+
+            if kind == STEP:
+                fields = STEP_RECORD.unpack_from(self.data, offset)[1:]
+            elif kind == WRITE:
+                fields = WRITE_RECORD.unpack_from(self.data, offset)[1:]
+            else:
+                fields = INTERRUPT_RECORD.unpack_from(self.data, offset)[1:]
+
+            yield index, kind, fields
+
+    def events(self):
+        """
+        Yield one event per step or interrupt, as dicts holding the memory
+        writes made along the way and, for steps, the registers that
+        changed.
+        """
+
+        writes = []
+        registers = None
+
+        for index, kind, fields in self.records():
+            if kind == WRITE:
+                address, old, new = fields
+                writes.append((address, old, new))
+                continue
+
+            if kind == INTERRUPT:
+                pc, handler = fields
+                yield {"index": index, "kind": "interrupt", "pc": pc,
+                       "handler": handler, "writes": writes}
+
+            else:
+                pc, ir, operand_a, operand_b, fl, regs = fields
+
+                # registers that changed since the previous step. The very
+                # first step has nothing to compare with, so all are shown
+                if registers is None:
+                    changed = [(r, None, regs[r]) for r in range(8)]
+                else:
+                    changed = [
+                        (r, registers[r], regs[r])
+                        for r in range(8) if registers[r] != regs[r]
+                    ]
+
+                registers = regs
+
+                yield {"index": index, "kind": "step", "pc": pc, "ir": ir,
+                       "operands": (operand_a, operand_b), "fl": fl,
+                       "registers": changed, "writes": writes}
+
+            writes = []
+
+
+def format_event(event):
+    """One line of human-readable text for an event."""
+
+    writes = " ".join(
+        f"[{address:02X}] {old:02X}->{new:02X}" for address, old, new in event["writes"]
+    )
+
+    if event["kind"] == "interrupt":
+        line = f"{event['index']:>10}  -- interrupt at {event['pc']:02X}, handler {event['handler']:02X}"
+
+    else:
+        name = OPCODE_NAMES.get(event["ir"], f"{event['ir']:02X}")
+        operand_a, operand_b = event["operands"]
+
+        registers = " ".join(
+            f"R{r} {new:02X}" if old is None else f"R{r} {old:02X}->{new:02X}"
+            for r, old, new in event["registers"]
+        )
+
+        line = (f"{event['index']:>10}  {event['pc']:02X}: {name:<4} "
+                f"{operand_a:02X} {operand_b:02X}  FL {event['fl']:02X}  {registers}")
+
+    if writes:
+        line += "  " + writes
+
+    return line
+
+
+def compare(a, b):
+    """
+    Return a description of the first event where two traces differ, or
+    None if they match. Trace indexes aren't compared, so traces whose ring
+    buffers wrapped differently still line up from their first event.
+    """
+
+    def key(event):
+        return {k: v for k, v in event.items() if k != "index"}
+
+    for event_a, event_b in zip(a.events(), b.events()):
+        if key(event_a) != key(event_b):
+            return f"< {format_event(event_a)}\n> {format_event(event_b)}"
+
+    if a.total != b.total:
+        return f"traces have {a.total} and {b.total} records"
+
+    return None
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        print("usage: tracer.py trace.bin [other.bin]", file=sys.stderr)
+        return 1
+
+    trace = TraceReader.open(argv[1])
+
+    if len(argv) == 3:
+        difference = compare(trace, TraceReader.open(argv[2]))
+        if difference is None:
+            print("traces match")
+            return 0
+        print(difference)
+        return 1
+
+    for event in trace.events():
+        print(format_event(event))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))